@@ -1,20 +1,89 @@
-import google.generativeai as genai
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 import os
-from googletrans import Translator
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.style import WD_STYLE_TYPE
-from collections import deque
+# google.generativeai, googletrans and python-docx are slow to import, so they are imported where first used
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import csv
+import hashlib
+import io
+import json
+import math
+import queue
+import random
+import re
+import sqlite3
+import sys
 import time
 import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Global API Key will be set after API window input
 api_key = None
 # Global preference for showing password or not
 show_password = False
+# Name of the Gemini model used for every generation
+MODEL_NAME = "gemini-pro"
+# Optional API endpoint override, e.g. a local stand-in server for benchmarks
+api_endpoint = os.environ.get("GEMINI_API_ENDPOINT")
+# Shared model client, rebuilt whenever the API key changes
+model_client = None
+# Model backend answering instead of Gemini (see use_backend), None for Gemini
+model_backend = None
+client_lock = threading.Lock()
+# One googletrans Translator per thread, each keeping its own connection pool
+translators = threading.local()
+# Long-lived pool translating chunks, so each worker thread keeps its translator between documents
+translation_executor = None
+TRANSLATION_WORKERS = 4
+# Output types and languages offered to users
+OUTPUT_TYPES = ["Ideas", "Lesson Plan"]
+LANGUAGES = ["English", "Nepali", "Nepali (direct)"]
+# Languages produced by translating the English output, with their googletrans codes
+TRANSLATED_LANGUAGES = {"Nepali": "ne"}
+# Languages the model is asked to write in directly, with the language named in the prompt
+DIRECT_LANGUAGES = {"Nepali (direct)": "Nepali"}
+# Segment translations already fetched in this run, most recently used last
+translation_memo = OrderedDict()
+translation_memo_lock = threading.Lock()
+TRANSLATION_MEMO_SIZE = 5000
+# Where generated outputs are cached between runs
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".steam_generator", "cache.sqlite3")
+# Shared response cache, opened on first use
+response_cache = None
+# Request budget for the shared scheduler (requests and tokens per minute, 0 means unlimited)
+REQUESTS_PER_MINUTE = int(os.environ.get("STEAM_REQUESTS_PER_MINUTE", "60"))
+TOKENS_PER_MINUTE = int(os.environ.get("STEAM_TOKENS_PER_MINUTE", "0"))
+# Shared request scheduler, created on first use
+request_scheduler = None
+# Optional metrics output: JSON lines log file and local port for the Prometheus-style endpoint
+METRICS_LOG = os.environ.get("STEAM_METRICS_LOG")
+METRICS_PORT = int(os.environ.get("STEAM_METRICS_PORT", "0"))
+# Where every generation is recorded
+HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".steam_generator", "history.sqlite3")
+# Shared history store, opened on first use
+history_store = None
+# Past lessons at least this similar to a request may be reused instead of calling Gemini, less similar ones
+# down to SIMILAR_SUGGEST are only pointed out
+SIMILAR_REUSE = float(os.environ.get("STEAM_SIMILAR_REUSE", "0.8"))
+SIMILAR_SUGGEST = 0.5
+# Similarity index over the history, set once it has been built
+similarity_index = None
+similarity_lock = threading.Lock()
+
+
+# Prompt budget: learning outcomes kept and their length, and the prompt tokens each output type may use before
+# the compact template is picked. STEAM_PROMPT_TEMPLATE forces "full" or "compact" instead of "auto"
+MAX_OUTCOMES = 8
+MAX_OUTCOME_CHARS = 200
+PROMPT_TOKEN_BUDGETS = {"Ideas": 400, "Lesson Plan": 900}
+PROMPT_TEMPLATE = os.environ.get("STEAM_PROMPT_TEMPLATE", "auto")
+# Output tokens allowed per output type: (base, per minute of class time, cap)
+OUTPUT_TOKEN_LIMITS = {"Ideas": (600, 15, 2048), "Lesson Plan": (1000, 30, 4096)}
+OUTLINE_TOKEN_LIMIT = 256
 
 
 def validate_api_key(key):
@@ -23,8 +92,27 @@ def validate_api_key(key):
         return True
     return False
 
-def generate_prompt(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None):
-    """Generates a prompt based on the input"""
+# Sections of a lesson plan, in order, with what each should contain
+LESSON_SECTIONS = [
+    ("Title of the Lesson", ""),
+    ("Learning Objectives", "Clearly restate the core learning outcomes, ensuring they are measurable and aligned with the desired knowledge, skills, and attitudes for students."),
+    ("Engage", "Design an activity that captures students’ attention at the beginning of the lesson. This activity should activate prior knowledge and spark curiosity about the new topic.Consider using questions, hands-on activities, or a thought-provoking visual or story."),
+    ("Explore", "Develop an interactive and exploratory activity where students can engage directly with the content in a hands-on or experiential way. This phase should allow students to make observations, test hypotheses, or solve problems in a safe and supportive environment."),
+    ("Explain", "Present clear explanations to help students make sense of the new concepts or skills they have encountered during exploration. Incorporate student-led discussions, demonstrations, or real-life examples to deepen their understanding."),
+    ("Elaborate", "Create an extension activity that challenges students to apply their learning in new or real-world contexts. Encourage them to make connections to broader concepts, current events, or personal experiences. This phase should help them think critically and extend their knowledge beyond the lesson."),
+    ("Evaluate", "Describe an evaluation method to assess whether students have met the learning objectives. This could include formative assessments such as quizzes, presentations, reflections, or peer evaluations. Provide rubrics or criteria for evaluating student understanding."),
+    ("Materials Needed", "List all materials required for the activities in the lesson plan. Be specific and include any tools, technology, or resources that will support the lesson."),
+    ("Detailed Lesson Procedure", "Outline the steps for the lesson, providing timing estimates for each phase (Engage, Explore, Explain, Elaborate, Evaluate). Ensure the activities are well-paced and offer opportunities for student reflection and inquiry."),
+    ("STEAM Integration", "Explicitly describe how Science, Technology, Engineering, Arts, and Mathematics are interconnected within the activities. Highlight how each discipline is applied in creative and meaningful ways, ensuring the integration supports holistic learning and encourages cross-disciplinary thinking."),
+]
+
+
+def generate_prompt(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None, language = "English",
+                    compact = False):
+    """Generates a prompt based on the input, or a shorter one asking for the same output if compact is set"""
+    if compact:
+        return generate_compact_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name) + language_instruction(language)
+    lesson_sections = "\n            ".join(f"*   {describe_section(title, description)}" for title, description in LESSON_SECTIONS)
     if output_type == "Ideas":
          prompt = f"""
             Develop a comprehensive and creative set of STEAM (Science, Technology, Engineering, Arts, Mathematics) integration possibilities
@@ -52,29 +140,2356 @@ def generate_prompt(topic, learning_outcomes, age_group, output_type, time_minut
             Given this context, generate a detailed lesson plan which follows the 5E model- Engage, Explore, Explain, Elaborate and Evaluate, which includes STEAM education related integrations.
             The lesson plan should include:
 
-            *   **Title of the Lesson**
-            *   **Learning Objectives** (Clearly restate the core learning outcomes, ensuring they are measurable and aligned with the desired knowledge, skills, and attitudes for students.)
-             *  **Engage** (Design an activity that captures students’ attention at the beginning of the lesson. This activity should activate prior knowledge and spark curiosity about the new topic.Consider using questions, hands-on activities, or a thought-provoking visual or story.)
-            *   **Explore** (Develop an interactive and exploratory activity where students can engage directly with the content in a hands-on or experiential way. This phase should allow students to make observations, test hypotheses, or solve problems in a safe and supportive environment.)
-            *  **Explain** (Present clear explanations to help students make sense of the new concepts or skills they have encountered during exploration. Incorporate student-led discussions, demonstrations, or real-life examples to deepen their understanding.)
-            *   **Elaborate** (Create an extension activity that challenges students to apply their learning in new or real-world contexts. Encourage them to make connections to broader concepts, current events, or personal experiences. This phase should help them think critically and extend their knowledge beyond the lesson.)
-            *  **Evaluate** (Describe an evaluation method to assess whether students have met the learning objectives. This could include formative assessments such as quizzes, presentations, reflections, or peer evaluations. Provide rubrics or criteria for evaluating student understanding.)
-            *   **Materials Needed** (List all materials required for the activities in the lesson plan. Be specific and include any tools, technology, or resources that will support the lesson.)
-            *   **Detailed Lesson Procedure** (Outline the steps for the lesson, providing timing estimates for each phase (Engage, Explore, Explain, Elaborate, Evaluate). Ensure the activities are well-paced and offer opportunities for student reflection and inquiry.)
-            *   **STEAM Integration** (Explicitly describe how Science, Technology, Engineering, Arts, and Mathematics are interconnected within the activities. Highlight how each discipline is applied in creative and meaningful ways, ensuring the integration supports holistic learning and encourages cross-disciplinary thinking.)
+            {lesson_sections}
             """
-    return prompt
+    return prompt + language_instruction(language)
+
+
+def generate_compact_prompt(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None):
+    """Short template for each output type, about a third of the full prompt's tokens."""
+    if output_type == "Ideas":
+        return f"""
+            Suggest creative STEAM (Science, Technology, Engineering, Arts, Mathematics) integration ideas for the topic "{topic}",
+            for learners aged {age_group}, in an activity of about {time_minutes} minutes.
+            Learning outcomes: {', '.join(learning_outcomes)}.
+            Cover each discipline with hands-on activities, real-world examples and discussion prompts. Stay realistic and on topic.
+            Use **Heading** for headings, *italic* for italics, and bullet points.
+            """
+    return f"""
+            Write a 5E (Engage, Explore, Explain, Elaborate, Evaluate) lesson plan with STEAM integration on: {topic},
+            for learners who are {age_group}, in a {time_minutes} minute session at {location_name}; briefly describe this location's context.
+            Learning outcomes: {', '.join(learning_outcomes)}.
+            Use these sections, each starting with its **Heading**: {', '.join(title for title, _ in LESSON_SECTIONS)}.
+            Give timings for each phase, specific materials and assessment criteria. Use *italic* for italics.
+            """
+
+
+def clean_outcomes(learning_outcomes, limit = MAX_OUTCOMES, max_chars = MAX_OUTCOME_CHARS):
+    """Strips, dedupes (ignoring case) and shortens learning outcomes, keeping at most limit of them in order."""
+    outcomes = []
+    seen = set()
+    for outcome in learning_outcomes:
+        outcome = " ".join(outcome.split())
+        if len(outcome) > max_chars:
+            outcome = outcome[:max_chars].rsplit(" ", 1)[0] + "..."
+        if outcome and outcome.casefold() not in seen:
+            seen.add(outcome.casefold())
+            outcomes.append(outcome)
+    return outcomes[:limit]
+
+
+def tidy_prompt(prompt):
+    """Drops the indentation and blank lines the templates carry, which cost tokens but tell the model nothing."""
+    return "\n".join(line.strip() for line in prompt.splitlines() if line.strip())
+
+
+def max_output_tokens(output_type, time_minutes = None):
+    """Output tokens allowed for a request, growing with the class time up to a cap."""
+    base, per_minute, cap = OUTPUT_TOKEN_LIMITS.get(output_type, OUTPUT_TOKEN_LIMITS["Lesson Plan"])
+    try:
+        minutes = max(0, int(time_minutes))
+    except (TypeError, ValueError):
+        minutes = 45
+    return min(cap, base + per_minute * minutes)
+
+
+def budget_prompt(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None,
+                  language = "English", template = None):
+    """Builds the prompt for a request within its token budget, returning it with what the budget decided.
+
+    Outcomes are cleaned first. The full template is used if it fits the budget for the output type, otherwise the
+    compact one, and outcomes are dropped from the end while even that is over budget. The result has the prompt,
+    the outcomes kept, the template used, the estimated prompt tokens and the max_output_tokens to request.
+    """
+    template = template or PROMPT_TEMPLATE
+    outcomes = clean_outcomes(learning_outcomes)
+    budget = PROMPT_TOKEN_BUDGETS.get(output_type, PROMPT_TOKEN_BUDGETS["Lesson Plan"])
+
+    def build(compact, kept):
+        return tidy_prompt(generate_prompt(topic, kept, age_group, output_type, time_minutes, location_name, language, compact))
+
+    compact = template == "compact"
+    prompt = build(compact, outcomes)
+    if template == "auto" and estimate_tokens(prompt) > budget:
+        compact = True
+        prompt = build(compact, outcomes)
+    while template != "full" and estimate_tokens(prompt) > budget and len(outcomes) > 1:
+        outcomes = outcomes[:-1]
+        prompt = build(compact, outcomes)
+    return {"prompt": prompt, "outcomes": outcomes, "template": "compact" if compact else "full",
+            "estimated_prompt_tokens": estimate_tokens(prompt), "max_output_tokens": max_output_tokens(output_type, time_minutes)}
+
+
+def record_budget(budget, details):
+    """Copies a prompt budget's estimates into a details dict and the metrics."""
+    instrumentation.count("estimated_prompt_tokens", budget["estimated_prompt_tokens"])
+    if details is not None:
+        details["prompt_template"] = budget["template"]
+        details["estimated_prompt_tokens"] = details.get("estimated_prompt_tokens", 0) + budget["estimated_prompt_tokens"]
+        details["max_output_tokens"] = budget["max_output_tokens"]
+
+
+def describe_section(title, description):
+    """Formats a lesson section as it is listed in prompts."""
+    return f"**{title}** ({description})" if description else f"**{title}**"
+
+
+def language_instruction(language):
+    """Returns the prompt suffix asking for output in a language other than English."""
+    if language == "English":
+        return ""
+    return f"""
+            Write the entire output in {language}. Keep the markdown markers (** and *) exactly as described above.
+            """
+
+
+def generate_outline_prompt(topic, learning_outcomes, age_group, time_minutes = None, location_name = None):
+    """Prompt for the short lesson outline that every section of a parallel lesson plan is written from."""
+    return f"""
+            Sketch a brief outline for a lesson plan on the topic: {topic} for learners who are {age_group}, following the 5E model
+            (Engage, Explore, Explain, Elaborate, Evaluate) with STEAM integrations. The session is {time_minutes} minutes long
+            and takes place at: {location_name or "a general classroom"}.
+
+            The learning outcomes for this lesson are:
+            {', '.join(learning_outcomes)}.
+
+            Give the lesson title, then one line per 5E phase naming its activity and minutes, then the key materials.
+            Keep the whole outline under 120 words, as plain bullet points. Other writers will expand it into the full plan.
+            """
+
+
+def generate_section_prompt(topic, learning_outcomes, age_group, time_minutes, location_name, outline, title, description,
+                            language = "English"):
+    """Prompt for one section of a parallel lesson plan, written from the shared outline."""
+    return f"""
+            You are writing one section of a lesson plan on the topic: {topic} for learners who are {age_group}.
+            The classroom session is {time_minutes} minutes long. Location Name: {location_name}
+            The learning outcomes are: {', '.join(learning_outcomes)}.
+
+            The whole lesson follows this outline, stay consistent with it:
+            {outline}
+
+            Write only this section: {describe_section(title, description)}
+            Start with the heading **{title}** on its own line and do not write any other section.
+            Use markdown style, for example, use **Heading** for headings and *italic* for italics.
+            """ + language_instruction(language)
+
+
+class ModelClient:
+    """Gemini configuration and model for one API key, created once and shared by every generation."""
+    def __init__(self, key, endpoint = None):
+        import google.generativeai as genai
+        self.api_key = key
+        self.endpoint = endpoint
+        if endpoint:
+            genai.configure(api_key=key, transport="rest", client_options={"api_endpoint": endpoint})
+        else:
+            genai.configure(api_key=key)
+        self.model = genai.GenerativeModel(MODEL_NAME) # Model objects are safe to share between threads
+
+
+def get_client():
+    """Returns the shared model client, building it the first time or after the API key has changed."""
+    global model_client
+    with client_lock:
+        if model_client is None or model_client.api_key != api_key or model_client.endpoint != api_endpoint:
+            model_client = ModelClient(api_key, api_endpoint)
+        return model_client
+
+
+def warm_up_client():
+    """Builds the shared model client in a background thread, so the first generation does not wait for it."""
+    def build():
+        try:
+            get_client()
+        except Exception:
+            pass # The first generation builds it again and reports the error
+    threading.Thread(target=build, daemon=True).start()
+
+
+def reset_client():
+    """Drops the shared model client so the next generation builds a new one."""
+    global model_client
+    with client_lock:
+        model_client = None
+
+
+def create_model():
+    """Returns the configured model backend, or the shared Gemini model for the current API key."""
+    if model_backend is not None:
+        return model_backend
+    return get_client().model
+
+
+def get_translator():
+    """Returns the calling thread's translator, creating it on first use."""
+    translator = getattr(translators, "translator", None)
+    if translator is None:
+        from googletrans import Translator
+        translator = translators.translator = Translator()
+    return translator
+
+
+def get_translation_executor():
+    """Returns the shared translation pool, starting it the first time."""
+    global translation_executor
+    with client_lock:
+        if translation_executor is None:
+            translation_executor = ThreadPoolExecutor(max_workers = TRANSLATION_WORKERS, thread_name_prefix = "translate")
+        return translation_executor
+
+
+def response_truncated(response):
+    """Whether the model stopped writing a response because it reached max_output_tokens."""
+    candidates = getattr(response, "candidates", None)
+    if not candidates:
+        return False
+    reason = getattr(candidates[0], "finish_reason", None)
+    return getattr(reason, "name", reason) in ("MAX_TOKENS", 2) # An enum from Gemini, 2 in the raw API
+
+
+def record_usage(response, details):
+    """Copies the token counts of a Gemini response into a details dict, if the response has them.
+
+    A response cut off at the output token limit also sets details["truncated"].
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if details is not None and usage is not None:
+        details["prompt_tokens"] = getattr(usage, "prompt_token_count", None)
+        details["output_tokens"] = getattr(usage, "candidates_token_count", None)
+    if details is not None and response_truncated(response):
+        details["truncated"] = True
+
+
+def count_usage(counts, details = None):
+    """Adds a finished request's actual token counts to the metrics, and to a details dict if one is given."""
+    for name in ("prompt_tokens", "output_tokens"):
+        if counts.get(name):
+            instrumentation.count(name, counts[name])
+    if counts.get("truncated"):
+        instrumentation.count("truncated")
+    if details is not None:
+        details.update((name, count) for name, count in counts.items() if count)
+
+
+def generate_steam_ideas(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None, model = None,
+                         language = "English", details = None, deadline = None, cancel_event = None):
+    """Generates elaborate STEAM integration ideas for a topic.
+
+    The call goes through the shared request scheduler, which may wait for the rate limit and retry transient
+    failures until the deadline (a time.monotonic() value) passes or cancel_event is set. If a details dict is
+    given, the token counts of the response are stored in it.
+    """
+    if model is None:
+        model = create_model()
+    with instrumentation.span("prompt", details):
+        budget = budget_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name, language)
+        record_budget(budget, details)
+    prompt = budget["prompt"]
+    config = {"max_output_tokens": budget["max_output_tokens"]}
+
+    try:
+        with instrumentation.span("model", details):
+            response = get_scheduler().call(lambda: model.generate_content(prompt, generation_config = config),
+                                            budget["estimated_prompt_tokens"], deadline = deadline, cancel_event = cancel_event)
+            usage = {}
+            record_usage(response, usage)
+            count_usage(usage, details)
+            text = response.text if response else None
+        if text:
+            return text # Valid response
+        else:
+            instrumentation.count("errors")
+            return "Error: Could not generate any meaningful output, please try again." # API response is empty or invalid
+    except Exception as e:
+        instrumentation.count("errors")
+        return f"Error generating STEAM ideas: {e}"
+
+
+def stream_steam_ideas(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None, model = None,
+                       language = "English", details = None, deadline = None, cancel_event = None):
+    """Generates STEAM ideas, yielding the text in chunks as the model streams it back.
+
+    Only starting the stream is scheduled and retried, a stream that fails halfway raises the error.
+    """
+    if model is None:
+        model = create_model()
+    with instrumentation.span("prompt", details):
+        budget = budget_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name, language)
+        record_budget(budget, details)
+    prompt = budget["prompt"]
+    config = {"max_output_tokens": budget["max_output_tokens"]}
+    started = time.perf_counter()
+    usage = {}
+    try:
+        stream = get_scheduler().call(lambda: model.generate_content(prompt, stream=True, generation_config = config),
+                                      budget["estimated_prompt_tokens"], deadline = deadline, cancel_event = cancel_event)
+        first_chunk = True
+        for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled("Request cancelled")
+            record_usage(chunk, usage) # The last chunk carries the totals
+            if first_chunk and details is not None:
+                details["first_chunk"] = round(time.perf_counter() - started, 3)
+            first_chunk = False
+            if chunk.text:
+                yield chunk.text
+    except Exception:
+        instrumentation.count("errors")
+        raise
+    finally:
+        # Timed by hand because the time spent by the consumer between chunks counts as model time too
+        elapsed = time.perf_counter() - started
+        count_usage(usage, details)
+        if details is not None:
+            stages = details.setdefault("stages", {})
+            stages["model"] = stages.get("model", 0.0) + elapsed
+        if instrumentation.enabled:
+            instrumentation.record("model", elapsed)
+
+
+def stream_lesson_sections(topic, learning_outcomes, age_group, time_minutes = None, location_name = None, model = None,
+                           language = "English", details = None, deadline = None, cancel_event = None, max_workers = None):
+    """Generates a lesson plan section by section, yielding the sections in order as soon as each is ready.
+
+    A short outline is generated first and given to every section as shared context. The sections are then
+    requested concurrently, so the wait is the outline plus the slowest section instead of the whole plan.
+    """
+    if model is None:
+        model = create_model()
+    started = time.perf_counter()
+    usage = {"prompt_tokens": 0, "output_tokens": 0}
+    usage_lock = threading.Lock()
+    learning_outcomes = clean_outcomes(learning_outcomes)
+    section_limit = section_token_limit(time_minutes)
+    if details is not None:
+        details["max_output_tokens"] = OUTLINE_TOKEN_LIMIT + section_limit * len(LESSON_SECTIONS)
+
+    def ask(prompt, limit):
+        tokens = estimate_tokens(prompt)
+        instrumentation.count("estimated_prompt_tokens", tokens)
+        with usage_lock:
+            if details is not None:
+                details["estimated_prompt_tokens"] = details.get("estimated_prompt_tokens", 0) + tokens
+        response = get_scheduler().call(lambda: model.generate_content(prompt, generation_config = {"max_output_tokens": limit}),
+                                        tokens, deadline = deadline, cancel_event = cancel_event)
+        counts = {}
+        record_usage(response, counts)
+        with usage_lock:
+            for name in ("prompt_tokens", "output_tokens"):
+                usage[name] += counts.get(name) or 0
+            if counts.get("truncated"):
+                usage["truncated"] = True
+        text = response.text if response else None
+        if not text:
+            raise ValueError("Could not generate any meaningful output, please try again.")
+        return text.strip()
+
+    executor = ThreadPoolExecutor(max_workers = max_workers or len(LESSON_SECTIONS))
+    try:
+        with instrumentation.span("prompt", details):
+            outline_prompt = tidy_prompt(generate_outline_prompt(topic, learning_outcomes, age_group, time_minutes, location_name))
+        outline = ask(outline_prompt, OUTLINE_TOKEN_LIMIT)
+        with instrumentation.span("prompt", details):
+            prompts = [tidy_prompt(generate_section_prompt(topic, learning_outcomes, age_group, time_minutes, location_name, outline,
+                                                           title, description, language)) for title, description in LESSON_SECTIONS]
+        futures = [executor.submit(ask, prompt, section_limit) for prompt in prompts]
+        for (title, _), future in zip(LESSON_SECTIONS, futures):
+            text = with_heading(title, future.result())
+            if details is not None and "first_chunk" not in details:
+                details["first_chunk"] = round(time.perf_counter() - started, 3)
+            yield text + "\n\n"
+    except Exception:
+        instrumentation.count("errors")
+        raise
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
+        elapsed = time.perf_counter() - started
+        if details is not None:
+            stages = details.setdefault("stages", {})
+            stages["model"] = stages.get("model", 0.0) + elapsed
+        count_usage(usage, details)
+        if instrumentation.enabled:
+            instrumentation.record("model", elapsed)
+
+
+def section_token_limit(time_minutes = None):
+    """Output tokens allowed for one lesson plan section."""
+    # Sections differ in length, so each may use twice its even share of the lesson's output tokens
+    return max(OUTLINE_TOKEN_LIMIT, 2 * max_output_tokens("Lesson Plan", time_minutes) // len(LESSON_SECTIONS))
+
+
+def with_heading(title, text):
+    """Puts the section heading in front of a section the model wrote without it."""
+    if title.casefold() not in text[:len(title) + 10].casefold():
+        return f"**{title}**\n{text}"
+    return text
+
+
+def section_description(title):
+    """What a lesson plan section should contain, for titles such as "Engage" or "Engage (10 minutes)"."""
+    for name, description in LESSON_SECTIONS:
+        if title.casefold().startswith(name.casefold()):
+            return description
+    return ""
+
+
+def regenerate_section(request, document, index, model = None, cache = None, details = None, deadline = None, cancel_event = None):
+    """Writes a new version of one section of a LessonDocument, with the other sections as compact context.
+
+    Only the section is requested, so it costs a fraction of the tokens and time of the whole output. Returns the
+    new section text, heading included, in the request's language; the document itself is left unchanged. The
+    cache, if given, is only used for translations, since a new version is wanted. Raises on failure.
+    """
+    if model is None:
+        model = create_model()
+    title = document.sections[index]["title"]
+    language = request["language"]
+    prompt_language = DIRECT_LANGUAGES.get(language, "English")
+    with instrumentation.span("prompt", details):
+        prompt = tidy_prompt(generate_section_prompt(request["topic"], clean_outcomes(request["outcomes"]), request["age_group"],
+                                                     request["time_minutes"], request["location_name"], document.context(index),
+                                                     title, section_description(title), prompt_language))
+        record_budget({"template": "section", "estimated_prompt_tokens": estimate_tokens(prompt),
+                       "max_output_tokens": section_token_limit(request["time_minutes"])}, details)
+    config = {"max_output_tokens": section_token_limit(request["time_minutes"])}
+    try:
+        with instrumentation.span("model", details):
+            response = get_scheduler().call(lambda: model.generate_content(prompt, generation_config = config),
+                                            estimate_tokens(prompt), deadline = deadline, cancel_event = cancel_event)
+            usage = {}
+            record_usage(response, usage)
+            count_usage(usage, details)
+            text = response.text if response else None
+        if not text:
+            raise ValueError("Could not generate any meaningful output, please try again.")
+    except Exception:
+        instrumentation.count("errors")
+        raise
+    text = with_heading(title, text.strip())
+    if language in TRANSLATED_LANGUAGES:
+        text = translate_document(text, TRANSLATED_LANGUAGES[language], cache = cache, details = details)
+        if text.startswith("Error"):
+            raise ValueError(text)
+    return text
+
+
+def generate_lesson_sections(topic, learning_outcomes, age_group, time_minutes = None, location_name = None, model = None,
+                             language = "English", details = None, deadline = None, cancel_event = None):
+    """Generates a whole lesson plan with parallel sections, returning an error message instead of raising."""
+    try:
+        return "".join(stream_lesson_sections(topic, learning_outcomes, age_group, time_minutes, location_name, model = model,
+                                              language = language, details = details, deadline = deadline,
+                                              cancel_event = cancel_event))
+    except Exception as e:
+        return f"Error generating STEAM ideas: {e}"
+
+
+# Instrumentation
+class Span:
+    """Times one stage. The duration is added to the request's details and, if enabled, to the global metrics."""
+    __slots__ = ("instrumentation", "stage", "details", "started")
+
+    def __init__(self, instrumentation, stage, details):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.details = details
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        elapsed = time.perf_counter() - self.started
+        if self.details is not None:
+            stages = self.details.setdefault("stages", {})
+            stages[self.stage] = stages.get(self.stage, 0.0) + elapsed
+        if self.instrumentation.enabled:
+            self.instrumentation.record(self.stage, elapsed, error_type is None)
+        return False
+
+
+class NullSpan:
+    """Span used when nothing is listening, so disabled instrumentation costs almost nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Instrumentation:
+    """Per-stage latency spans and event counters, logged as JSON lines and served in Prometheus text format.
+
+    Stages are "prompt", "model", "translate", "render" and "export". Disabled by default; spans still fill in
+    a request's details dict when one is passed, which is how the GUI shows the last request's breakdown.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stages = {} # stage -> [count, total seconds, errors]
+        self._counters = {}
+        self._log_file = None
+        self._server = None
+
+    def configure(self, log_path = None, port = 0):
+        """Enables instrumentation, writing to a JSON lines log and/or serving metrics on a local port."""
+        with self._lock:
+            if log_path and self._log_file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+                self._log_file = open(log_path, "a", encoding="utf-8")
+            self.enabled = True
+        if port and self._server is None:
+            self._server = serve_metrics(self, port)
+
+    def span(self, stage, details = None):
+        """Returns a context manager timing a stage of the current request."""
+        if not self.enabled and details is None:
+            return NULL_SPAN
+        return Span(self, stage, details)
+
+    def record(self, stage, seconds, ok = True):
+        """Adds a finished span to the totals and the log."""
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            if not ok:
+                totals[2] += 1
+        self.log({"event": "span", "stage": stage, "seconds": round(seconds, 6), "ok": ok})
+
+    def count(self, name, amount = 1):
+        """Increments an event counter such as cache_hits, errors or retries."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        self.log({"event": "count", "name": name, "amount": amount})
+
+    def log(self, record):
+        """Writes a record to the JSON lines log, if there is one."""
+        if self._log_file is None:
+            return
+        record["time"] = round(time.time(), 3)
+        line = json.dumps(record)
+        with self._lock:
+            self._log_file.write(line + "\n")
+            self._log_file.flush()
+
+    def snapshot(self):
+        """Returns the stage totals and counters collected so far."""
+        with self._lock:
+            stages = {stage: {"count": count, "seconds": round(total, 6), "errors": errors}
+                      for stage, (count, total, errors) in self._stages.items()}
+            return {"stages": stages, "counters": dict(self._counters)}
+
+    def prometheus_text(self):
+        """Renders the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ["# TYPE steam_stage_seconds summary"]
+        for stage, totals in sorted(snapshot["stages"].items()):
+            lines.append(f'steam_stage_seconds_sum{{stage="{stage}"}} {totals["seconds"]}')
+            lines.append(f'steam_stage_seconds_count{{stage="{stage}"}} {totals["count"]}')
+        lines.append("# TYPE steam_stage_errors_total counter")
+        for stage, totals in sorted(snapshot["stages"].items()):
+            lines.append(f'steam_stage_errors_total{{stage="{stage}"}} {totals["errors"]}')
+        lines.append("# TYPE steam_events_total counter")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f'steam_events_total{{event="{name}"}} {value}')
+        if request_scheduler is not None:
+            lines.append("# TYPE steam_scheduler gauge")
+            for name, value in sorted(request_scheduler.metrics().items()):
+                lines.append(f'steam_scheduler{{metric="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(instrumentation, port):
+    """Serves instrumentation.prometheus_text() at http://127.0.0.1:port/metrics from a background thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = instrumentation.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def format_stages(details):
+    """Formats a request's stage timings for the status line, e.g. "model 2.31s · render 0.02s"."""
+    stages = (details or {}).get("stages", {})
+    order = ("prompt", "model", "translate", "render", "export")
+    parts = [f"{stage} {stages[stage]:.2f}s" for stage in order if stage in stages]
+    if (details or {}).get("similarity"):
+        parts.insert(0, f"reused a past lesson ({details['similarity']:.0%} similar)")
+    elif (details or {}).get("cached"):
+        parts.insert(0, "cache hit")
+    elif (details or {}).get("coalesced"):
+        parts.insert(0, "shared with an identical request")
+    tokens = format_tokens(details)
+    if tokens:
+        parts.append(tokens)
+    if (details or {}).get("truncated"):
+        parts.append("cut off at the output token limit, not cached")
+    return " · ".join(parts)
+
+
+def format_tokens(details):
+    """Formats estimated against actual token counts, e.g. "tokens 310 in (est. 298), 1450 out of 2200"."""
+    details = details or {}
+    estimated = details.get("estimated_prompt_tokens")
+    if not estimated:
+        return ""
+    prompt_tokens = details.get("prompt_tokens")
+    text = f"tokens {prompt_tokens} in (est. {estimated})" if prompt_tokens else f"tokens est. {estimated} in"
+    if details.get("output_tokens"):
+        text += f", {details['output_tokens']} out"
+        if details.get("max_output_tokens"):
+            text += f" of {details['max_output_tokens']}"
+    return text
+
+
+def token_counts(details):
+    """Returns the estimated and actual token counts of a request, as recorded in its details.
+
+    Whether the output was cut off at the token limit is in details["truncated"].
+    """
+    return {name: details.get(name) for name in ("estimated_prompt_tokens", "prompt_tokens", "output_tokens", "max_output_tokens")}
+
+
+instrumentation = Instrumentation()
+
+
+# Request scheduling
+class RequestCancelled(Exception):
+    """Raised when a scheduled request is cancelled before it completes."""
+
+
+class RequestTimeout(Exception):
+    """Raised when a scheduled request cannot complete before its deadline."""
+
+
+def estimate_tokens(text):
+    """Roughly estimates the number of Gemini tokens in a text (about four characters per token)."""
+    return max(1, len(text) // 4)
+
+
+def is_transient_error(error):
+    """Checks whether a failed request is worth retrying (quota, overload, timeouts and dropped connections)."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    code = getattr(error, "code", None)
+    if callable(code):
+        code = None # gRPC errors expose code() as a method
+    if code in (429, 500, 502, 503, 504):
+        return True
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                                "DeadlineExceeded", "GatewayTimeout", "BadGateway"):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message
+
+
+class TokenBucket:
+    """Allows rate_per_minute units per minute on average, with bursts of up to capacity units."""
+    def __init__(self, rate_per_minute, capacity = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Takes amount units and returns how many seconds the caller must wait before using them.
+
+        The bucket may go into debt, which makes later callers wait their turn behind earlier ones.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        """Gives back units reserved by a request that never ran."""
+        with self._lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RequestScheduler:
+    """Runs model calls within a requests and tokens per minute budget, retrying transient failures.
+
+    Retries use exponential backoff with jitter. Every wait respects the caller's deadline and cancel event.
+    burst limits how many requests may start at once (a full minute's worth by default).
+    """
+    def __init__(self, requests_per_minute = REQUESTS_PER_MINUTE, tokens_per_minute = TOKENS_PER_MINUTE, max_retries = 4,
+                 base_delay = 1.0, max_delay = 30.0, burst = None):
+        self.request_bucket = TokenBucket(requests_per_minute, burst) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._counters = {"waiting": 0, "in_flight": 0, "completed": 0, "failed": 0, "retries": 0, "throttled": 0,
+                          "throttle_seconds": 0.0, "cancelled": 0, "timed_out": 0}
+
+    def _count(self, name, amount = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _sleep(self, seconds, deadline, cancel_event):
+        """Waits, giving up early if the deadline would pass or the request is cancelled."""
+        if deadline is not None and time.monotonic() + seconds > deadline:
+            raise RequestTimeout("Request could not be completed before its deadline")
+        if cancel_event is not None:
+            if cancel_event.wait(seconds):
+                raise RequestCancelled("Request cancelled")
+        elif seconds > 0:
+            time.sleep(seconds)
+
+    def _wait_for_budget(self, tokens, deadline, cancel_event):
+        """Reserves one request and the estimated tokens, waiting until the budget allows them."""
+        wait = 0.0
+        if self.request_bucket:
+            wait = self.request_bucket.reserve(1)
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        if wait <= 0:
+            return
+        self._count("throttled")
+        instrumentation.count("throttled")
+        self._count("throttle_seconds", wait)
+        self._count("waiting")
+        try:
+            self._sleep(wait, deadline, cancel_event)
+        except (RequestCancelled, RequestTimeout):
+            if self.request_bucket:
+                self.request_bucket.refund(1)
+            if self.token_bucket:
+                self.token_bucket.refund(tokens)
+            raise
+        finally:
+            self._count("waiting", -1)
+
+    def call(self, function, tokens = 1, deadline = None, cancel_event = None):
+        """Calls function() within the budget and returns its result, retrying transient errors."""
+        attempt = 0
+        try:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled("Request cancelled")
+                self._wait_for_budget(tokens, deadline, cancel_event)
+                self._count("in_flight")
+                try:
+                    result = function()
+                except Exception as e:
+                    if not is_transient_error(e) or attempt >= self.max_retries:
+                        self._count("failed")
+                        raise
+                    error = e
+                else:
+                    self._count("completed")
+                    return result
+                finally:
+                    self._count("in_flight", -1)
+                # Backoff doubles each attempt, jitter spreads out clients that failed together
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay)
+                attempt += 1
+                self._count("retries")
+                instrumentation.count("retries")
+                try:
+                    self._sleep(delay, deadline, cancel_event)
+                except RequestTimeout:
+                    raise RequestTimeout(f"Request could not be completed before its deadline: {error}") from error
+        except RequestCancelled:
+            self._count("cancelled")
+            raise
+        except RequestTimeout:
+            self._count("timed_out")
+            raise
+
+    def metrics(self):
+        """Returns a snapshot of the queue depth and throttling, retry and outcome counters."""
+        with self._lock:
+            snapshot = dict(self._counters)
+        snapshot["throttle_seconds"] = round(snapshot["throttle_seconds"], 3)
+        return snapshot
+
+
+def get_scheduler():
+    """Returns the shared request scheduler, creating it on first use."""
+    global request_scheduler
+    with client_lock:
+        if request_scheduler is None:
+            request_scheduler = RequestScheduler()
+        return request_scheduler
+
+
+# Request coalescing
+class Flight:
+    """One upstream call, shared by every identical request waiting on it."""
+    def __init__(self):
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.waiters = 0
+        self.details = {}
+        self.cancel_event = threading.Event()
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """Coalesces identical in-flight requests so that they share one upstream call.
+
+    The first request for a key starts the work in a background thread, identical requests arriving before it
+    finishes attach to it and receive the same chunks, or the same exception. Each caller waits with its own
+    deadline and cancel event, and the work is cancelled once every caller has left.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def stream(self, key, produce, deadline = None, cancel_event = None, details = None):
+        """Yields the chunks of produce(cancel_event, details) for key, joining the call already running if any.
+
+        produce gets the flight's own cancel event and details dict, but no deadline: each caller's deadline only
+        applies to its own wait (until the first chunk arrives, like the scheduler's), and the work goes on as long
+        as anyone still waits for it. When the call completes, its details are merged into the given dict, adding
+        its stage timings to the ones the caller recorded itself.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            flight.waiters += 1
+        if leader:
+            threading.Thread(target = self._run, args = (key, flight, produce), daemon = True).start()
+        else:
+            instrumentation.count("coalesced")
+        try:
+            index = 0
+            finished = False
+            while not finished:
+                with flight.condition:
+                    while index == len(flight.chunks) and not flight.done:
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise RequestCancelled("Request cancelled")
+                        if deadline is not None and index == 0 and time.monotonic() > deadline:
+                            raise RequestTimeout("Request could not be completed before its deadline")
+                        flight.condition.wait(0.1)
+                    chunks = flight.chunks[index:]
+                    finished = flight.done
+                index += len(chunks)
+                yield from chunks
+            if flight.error is not None:
+                raise flight.error
+            if details is not None:
+                if "stages" in flight.details:
+                    stages = details.setdefault("stages", {}) # May already hold e.g. render time of streamed chunks
+                    for stage, seconds in flight.details["stages"].items():
+                        stages[stage] = stages.get(stage, 0.0) + seconds
+                details.update((name, value) for name, value in flight.details.items() if name != "stages")
+                details["coalesced"] = not leader
+        finally:
+            self._leave(key, flight)
+
+    def call(self, key, produce, deadline = None, cancel_event = None, details = None):
+        """Returns the text produced by produce(cancel_event, details) for key, sharing a call already running."""
+        return "".join(self.stream(key, lambda flight_cancel, flight_details: [produce(flight_cancel, flight_details)],
+                                   deadline, cancel_event, details))
+
+    def _run(self, key, flight, produce):
+        try:
+            for chunk in produce(flight.cancel_event, flight.details):
+                with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def _leave(self, key, flight):
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.done:
+                flight.cancel_event.set() # Nobody wants the result any more
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def in_flight(self):
+        """Returns how many upstream calls are running."""
+        with self._lock:
+            return len(self._flights)
+
+
+request_flights = SingleFlight()
+
+
+# Markdown-safe translation
+LINE_PREFIX_PATTERN = re.compile(r"^\s*(?:#{1,6}|[*+-]|\d+[.)])\s+") # Bullets, numbering and heading hashes
+MARKER_PATTERN = re.compile(r"(\*\*|\*)")
+EDGE_MARKUP_PATTERN = re.compile(r"[*\s]*") # Markers and spaces at either end of a line are never sent
+PLACEHOLDER_PATTERN = re.compile(r"\{(\d+)\}")
+PLACEHOLDER_SPLIT_PATTERN = re.compile(r"(\{\d+\})")
+
+
+def split_translatable(text):
+    """Splits text into a template of protected markup and the text segments that need translating.
+
+    Each line is sent as one segment so the translator keeps its word order: leading and trailing markup stays
+    in the template, and ** and * markers inside the line become {0}, {1}, ... placeholders. Each template line is
+    a list of parts: plain strings are kept as they are, (index, markers) pairs point into the segment list.
+    """
+    segments = []
+    positions = {}
+    template = []
+    for line in text.split("\n"):
+        parts = []
+        prefix = LINE_PREFIX_PATTERN.match(line)
+        if prefix:
+            parts.append(prefix.group(0))
+            line = line[prefix.end():]
+        lead = EDGE_MARKUP_PATTERN.match(line).group(0)
+        body = line[len(lead):]
+        tail = EDGE_MARKUP_PATTERN.match(body[::-1]).group(0)[::-1]
+        body = body[:len(body) - len(tail)]
+        if "{" in body or "}" in body:
+            pieces = MARKER_PATTERN.split(body) # The line's own braces would clash with the placeholders
+        else:
+            pieces = [body]
+        parts.append(lead)
+        for piece in pieces:
+            if not any(character.isalpha() for character in piece):
+                parts.append(piece) # Markers, numbers and punctuation stay untouched
+                continue
+            markers = MARKER_PATTERN.findall(piece)
+            numbers = iter(range(len(markers)))
+            core = MARKER_PATTERN.sub(lambda match: "{%d}" % next(numbers), piece)
+            start = len(core) - len(core.lstrip())
+            core = core.strip()
+            if core not in positions:
+                positions[core] = len(segments)
+                segments.append(core)
+            parts.extend([piece[:start], (positions[core], markers), piece[len(piece.rstrip()):]])
+        parts.append(tail)
+        template.append(parts)
+    return template, segments
+
+
+def join_translated(template, translations):
+    """Rebuilds the document from a template and the translated segments, putting the markers back."""
+    def restore(part):
+        if isinstance(part, str):
+            return part
+        index, markers = part
+        return PLACEHOLDER_PATTERN.sub(lambda match: markers[int(match.group(1))], translations[index]) if markers \
+            else translations[index]
+    return "\n".join("".join(restore(part) for part in parts) for parts in template)
+
+
+def translate_pieces(segment, dest, translator):
+    """Translates the text between a segment's placeholders one piece at a time, keeping the placeholders."""
+    return "".join(
+        piece if PLACEHOLDER_PATTERN.fullmatch(piece) or not piece.strip()
+        else piece[:len(piece) - len(piece.lstrip())] + translator.translate(piece.strip(), dest=dest).text.strip()
+        + piece[len(piece.rstrip()):]
+        for piece in PLACEHOLDER_SPLIT_PATTERN.split(segment)
+    )
+
+
+def translate_chunk(segments, dest, translator):
+    """Translates a list of segments with one request, falling back to one request each if the lines get merged.
+
+    A segment whose placeholders come back missing, repeated or out of order is translated piece by piece instead.
+    """
+    translated = translator.translate("\n".join(segments), dest=dest).text.split("\n")
+    if len(translated) != len(segments):
+        translated = [translator.translate(segment, dest=dest).text for segment in segments]
+    return [
+        line.strip() if PLACEHOLDER_PATTERN.findall(line) == PLACEHOLDER_PATTERN.findall(segment)
+        else translate_pieces(segment, dest, translator)
+        for segment, line in zip(segments, translated)
+    ]
+
+
+def remember_translation(key, value = None):
+    """Reads (or with a value, stores) a segment translation in the in-memory memo."""
+    with translation_memo_lock:
+        if value is None:
+            value = translation_memo.get(key)
+            if value is not None:
+                translation_memo.move_to_end(key)
+            return value
+        translation_memo[key] = value
+        if len(translation_memo) > TRANSLATION_MEMO_SIZE:
+            translation_memo.popitem(last=False)
+        return value
+
+
+def translate_document(text, dest, cache = None, chunk_chars = 1500, translator = None, details = None, progress = None):
+    """Translates a markdown document, timing it as the "translate" stage."""
+    with instrumentation.span("translate", details):
+        translated = translate_segments(text, dest, cache, chunk_chars, translator, progress)
+    if translated.startswith("Error"):
+        instrumentation.count("errors")
+    return translated
+
+
+def translate_segments(text, dest, cache = None, chunk_chars = 1500, translator = None, progress = None):
+    """Translates a markdown document segment by segment, keeping its ** and * markers intact.
+
+    Segments already translated (in this run, or in the cache's segment store) are reused, the rest are grouped into chunks of
+    roughly chunk_chars characters and translated concurrently on the shared translation pool. progress, if
+    given, is called with (chunks done, total chunks) as they finish.
+    """
+    template, segments = split_translatable(text)
+    translations = [None] * len(segments)
+    missing = []
+    cache = cache.translations if cache is not None else None # Segments never share the outputs' table
+    for index, segment in enumerate(segments):
+        key = cache_key(segment, "googletrans", dest)
+        found = remember_translation(key)
+        if found is None and cache is not None:
+            found = cache.get(key)
+            if found is not None:
+                remember_translation(key, found)
+        if found is None:
+            missing.append(index)
+        else:
+            translations[index] = found
+
+    chunks = [[]]
+    size = 0
+    for index in missing:
+        if chunks[-1] and size + len(segments[index]) > chunk_chars:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(index)
+        size += len(segments[index]) + 1
+    chunks = [chunk for chunk in chunks if chunk]
+
+    def run_chunk(indexes):
+        return translate_chunk([segments[index] for index in indexes], dest, translator or get_translator())
+
+    executor = get_translation_executor() if chunks else None
+    futures = [executor.submit(run_chunk, chunk) for chunk in chunks]
+    try:
+        for done, (indexes, future) in enumerate(zip(chunks, futures), 1):
+            for index, value in zip(indexes, future.result()):
+                translations[index] = value
+                key = cache_key(segments[index], "googletrans", dest)
+                remember_translation(key, value)
+                if cache is not None:
+                    cache.put(key, value)
+            if progress:
+                progress(done, len(chunks))
+    except Exception as e:
+        for future in futures:
+            future.cancel()
+        return f"Error in translation: {e}"
+    return join_translated(template, translations)
+
+
+# Markdown rendering
+BULLET_PATTERN = re.compile(r"^(\s*)[*+-]\s+")
+HEADING_PATTERN = re.compile(r"^\s*#{1,6}\s+")
+INLINE_PATTERN = re.compile(r"\*\*(.+?)\*\*|\*(?=\S)(.+?)(?<=\S)\*")
+
+
+def parse_markdown(text):
+    """Turns markdown output into a compact list of (text, style) spans in a single pass.
+
+    A bold span that opens a line (or a # line) is a "heading", other bold spans are "subheading", *text* is "italic"
+    and everything else has style None. Bullets become "•". Adjacent text with the same style, newlines included, is
+    merged into one span, so renderers need one insert or run per span rather than per word.
+    """
+    spans = []
+    pieces = []
+    current = None
+
+    def add(piece, style):
+        nonlocal current
+        if not piece:
+            return
+        if style != current and pieces:
+            spans.append(("".join(pieces), current))
+            pieces.clear()
+        current = style
+        pieces.append(piece)
+
+    for line in text.split("\n"):
+        heading = HEADING_PATTERN.match(line)
+        if heading:
+            add(line[heading.end():].replace("*", ""), "heading")
+            add("\n", None)
+            continue
+        bullet = BULLET_PATTERN.match(line)
+        if bullet:
+            add(bullet.group(1) + "• ", None)
+            line = line[bullet.end():]
+        position = 0
+        for match in INLINE_PATTERN.finditer(line):
+            add(line[position:match.start()], None)
+            if match.group(1) is not None:
+                add(match.group(1), "heading" if not line[:match.start()].strip() else "subheading")
+            else:
+                add(match.group(2), "italic")
+            position = match.end()
+        add(line[position:], None)
+        add("\n", None)
+    if pieces:
+        spans.append(("".join(pieces), current))
+    return spans
+
+
+def split_span_lines(spans):
+    """Regroups spans into lines (lists of spans without newlines), e.g. for one DOCX paragraph per line."""
+    line = []
+    for text, style in spans:
+        parts = text.split("\n")
+        for part in parts[:-1]:
+            if part:
+                line.append((part, style))
+            yield line
+            line = []
+        if parts[-1]:
+            line.append((parts[-1], style))
+    if line:
+        yield line
+
+
+def add_spans_to_document(document, spans):
+    """Adds parsed spans to a DOCX document, one paragraph per line and one run per span, returning the paragraphs."""
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    paragraphs = []
+    for line in split_span_lines(spans):
+        p = document.add_paragraph()
+        paragraphs.append(p)
+        for text, style in line:
+            run = p.add_run(text)
+            if style == "heading":
+                run.bold = True
+                run.font.size = Pt(14)  # Set bold fonts as headings
+            elif style == "subheading":
+                run.bold = True
+                run.font.size = Pt(13)  # Set bold fonts as sub headings
+            elif style == "italic":
+                run.italic = True
+        p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+    return paragraphs
+
+
+def new_document():
+    """Creates a DOCX document with the app's default font."""
+    from docx import Document
+    from docx.shared import Pt
+    document = Document()
+    # Apply Helvetica font to the entire document
+    style = document.styles["Normal"]
+    style.font.name = "Helvetica"
+    style.font.size = Pt(11)  # Set default font size
+    return document
+
+
+def write_docx(text, file_path, details = None):
+    """Saves markdown output as a formatted DOCX file."""
+    with instrumentation.span("export", details):
+        document = new_document()
+        add_spans_to_document(document, parse_markdown(text))
+        document.save(file_path)
+
+
+def add_table_of_contents(document):
+    """Adds a table of contents field listing the lesson headings; Word fills it in when fields are updated."""
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    run = document.add_paragraph().add_run()
+    begin = OxmlElement("w:fldChar")
+    begin.set(qn("w:fldCharType"), "begin")
+    instruction = OxmlElement("w:instrText")
+    instruction.set(qn("xml:space"), "preserve")
+    instruction.text = 'TOC \\o "1-1" \\h \\z \\u'
+    separate = OxmlElement("w:fldChar")
+    separate.set(qn("w:fldCharType"), "separate")
+    placeholder = OxmlElement("w:t")
+    placeholder.text = "Right-click and choose Update Field to show the table of contents."
+    end = OxmlElement("w:fldChar")
+    end.set(qn("w:fldCharType"), "end")
+    for element in (begin, instruction, separate, placeholder, end):
+        run._r.append(element)
+
+
+def export_combined_docx(items, file_path, progress = None):
+    """Writes (title, text) items into one DOCX with a table of contents and each lesson on its own page.
+
+    Items are consumed one at a time, so they can be streamed from a history or batch results file.
+    """
+    document = new_document()
+    document.add_heading("STEAM Lessons", level=0)
+    add_table_of_contents(document)
+    count = 0
+    for title, text in items:
+        document.add_page_break()
+        document.add_heading(title, level=1)
+        add_spans_to_document(document, parse_markdown(text))
+        count += 1
+        if progress:
+            progress(count)
+    document.save(file_path)
+    return count
+
+
+def export_docx_zip(items, file_path, progress = None):
+    """Writes each (title, text) item as its own DOCX inside a zip file, keeping only one document in memory at a time."""
+    count = 0
+    with zipfile.ZipFile(file_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for title, text in items:
+            count += 1
+            name = re.sub(r"[^\w\- ]+", "", title).strip()[:60] or "lesson"
+            name = f"{count:04d} {name}.docx" # Numbered so names stay unique and in order
+            buffer = io.BytesIO()
+            document = new_document()
+            document.add_heading(title, level=1)
+            add_spans_to_document(document, parse_markdown(text))
+            document.save(buffer)
+            archive.writestr(name, buffer.getvalue())
+            if progress:
+                progress(count)
+    return count
+
+
+def export_lessons(items, file_path, progress = None):
+    """Exports lessons as one combined DOCX, or as a zip of DOCX files when the path ends in .zip."""
+    if file_path.lower().endswith(".zip"):
+        return export_docx_zip(items, file_path, progress)
+    return export_combined_docx(items, file_path, progress)
+
+
+def read_batch_results(path):
+    """Reads (title, output) pairs from a batch results file, skipping rows that failed."""
+    with open(path, encoding="utf-8") as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.get("output"):
+                yield f"{result['index'] + 1}. {result['topic']}", result["output"]
+
+
+def generate_output(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None,
+                    language = "English", model = None, cache = None, details = None, deadline = None, cancel_event = None,
+                    parallel_sections = False, progress = None):
+    """Generates the output in the chosen language, serving repeated requests from the cache if one is given.
+
+    If a details dict is given, it is filled with whether the cache answered and the token counts. Past the
+    deadline, or once cancel_event is set, the caller stops waiting, and the model call is cancelled if no identical
+    request still waits for it. With parallel_sections, lesson plans are generated
+    section by section in parallel. progress, if given, is called with short status messages.
+    """
+    prompt_language = DIRECT_LANGUAGES.get(language, "English")
+    prompt = budget_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name, prompt_language)["prompt"]
+    sectioned = parallel_sections and output_type == "Lesson Plan"
+    key = cache_key(prompt, model_name(model) + "/sections" if sectioned else model_name(model), language)
+    if details is not None:
+        details["cached"] = False
+    if cache is not None:
+        cached = cache.get(key)
+        instrumentation.count("cache_misses" if cached is None else "cache_hits")
+        if cached is not None:
+            if details is not None:
+                details["cached"] = True
+            return cached
+
+    # The shared call gets no deadline, a caller that attaches later may be willing to wait longer
+    def produce(flight_cancel, flight_details):
+        if progress:
+            progress("Writing lesson sections..." if sectioned else "Waiting for Gemini...")
+        if sectioned:
+            text = generate_lesson_sections(topic, learning_outcomes, age_group, time_minutes, location_name, model = model,
+                                            language = prompt_language, details = flight_details,
+                                            cancel_event = flight_cancel)
+        else:
+            text = generate_steam_ideas(topic, learning_outcomes, age_group, output_type, time_minutes, location_name,
+                                        model = model, language = prompt_language, details = flight_details,
+                                        cancel_event = flight_cancel)
+        if not text.startswith("Error") and language in TRANSLATED_LANGUAGES:
+            report = (lambda done, total: progress(f"Translating: {done} of {total} parts")) if progress else None
+            text = translate_document(text, TRANSLATED_LANGUAGES[language], cache = cache, details = flight_details,
+                                      progress = report)
+        if cache is not None and not text.startswith("Error") and not flight_details.get("truncated"):
+            cache.put(key, text) # Errors and outputs cut off at the token limit are never cached
+        return text
+
+    try:
+        # Identical requests already running (a double click, or several teachers) share one model call
+        return request_flights.call(("text", key), produce, deadline, cancel_event, details)
+    except Exception as e:
+        return f"Error generating STEAM ideas: {e}"
+
+
+def stream_output(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None,
+                  language = "English", model = None, cache = None, details = None, deadline = None, cancel_event = None,
+                  parallel_sections = False):
+    """Streaming version of generate_output, yielding chunks as they arrive (whole sections with parallel_sections).
+
+    Only languages the model writes directly can be streamed, translated ones need the whole text first.
+    """
+    prompt_language = DIRECT_LANGUAGES.get(language, "English")
+    prompt = budget_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name, prompt_language)["prompt"]
+    sectioned = parallel_sections and output_type == "Lesson Plan"
+    key = cache_key(prompt, model_name(model) + "/sections" if sectioned else model_name(model), language)
+    if details is not None:
+        details["cached"] = False
+    if cache is not None:
+        cached = cache.get(key)
+        instrumentation.count("cache_misses" if cached is None else "cache_hits")
+        if cached is not None:
+            if details is not None:
+                details["cached"] = True
+            yield cached # A cached output arrives as a single chunk
+            return
+
+    def produce(flight_cancel, flight_details):
+        chunks = []
+        if sectioned:
+            stream = stream_lesson_sections(topic, learning_outcomes, age_group, time_minutes, location_name, model = model,
+                                            language = prompt_language, details = flight_details,
+                                            cancel_event = flight_cancel)
+        else:
+            stream = stream_steam_ideas(topic, learning_outcomes, age_group, output_type, time_minutes, location_name,
+                                        model = model, language = prompt_language, details = flight_details,
+                                        cancel_event = flight_cancel)
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        if cache is not None and chunks and not flight_details.get("truncated"):
+            cache.put(key, "".join(chunks))
+
+    yield from request_flights.stream(("stream", key), produce, deadline, cancel_event, details)
+
+
+def make_request(topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None,
+                 language = "English"):
+    """Bundles the inputs of a generation into a dict, e.g. for the history."""
+    return {
+        "topic": topic,
+        "outcomes": [outcome.strip() for outcome in learning_outcomes],
+        "age_group": age_group,
+        "output_type": output_type,
+        "time_minutes": time_minutes,
+        "location_name": location_name,
+        "language": language,
+    }
+
+
+# Request fields that take one value each (outcomes may also be a list)
+SINGLE_VALUE_FIELDS = ("topic", "age_group", "age", "output_type", "time_minutes", "time", "location_name", "location",
+                       "language")
+
+
+def parse_request(fields):
+    """Builds a request dict from loosely named input fields, as found in batch files and API calls.
+
+    Raises ValueError if a required field is missing or a value is not one the generator supports.
+    """
+    for name in SINGLE_VALUE_FIELDS:
+        if isinstance(fields.get(name), (list, dict)):
+            raise ValueError(f"{name} must be a single value")
+    outcomes = fields.get("outcomes") or fields.get("learning_outcomes") or ""
+    if isinstance(outcomes, str):
+        outcomes = outcomes.split(",")
+    if not isinstance(outcomes, list) or not all(isinstance(outcome, str) for outcome in outcomes):
+        raise ValueError("outcomes must be a list of strings or one comma-separated string")
+    request = make_request(
+        str(fields.get("topic") or "").strip(), outcomes, str(fields.get("age_group") or fields.get("age") or "").strip(),
+        fields.get("output_type") or "Ideas", fields.get("time_minutes") or fields.get("time"),
+        fields.get("location_name") or fields.get("location") or "", fields.get("language") or "English",
+    )
+    if not request["topic"] or not request["age_group"] or not request["time_minutes"]:
+        raise ValueError("topic, age and time are required")
+    try:
+        request["time_minutes"] = int(request["time_minutes"])
+    except (TypeError, ValueError):
+        raise ValueError("time must be a whole number of minutes")
+    if request["output_type"] not in OUTPUT_TYPES:
+        raise ValueError(f"output type must be one of: {', '.join(OUTPUT_TYPES)}")
+    if request["language"] not in LANGUAGES:
+        raise ValueError(f"language must be one of: {', '.join(LANGUAGES)}")
+    return request
+
+
+# Section-indexed documents
+SECTION_HEADING_PATTERN = re.compile(r"^\s*(?:#{1,6}\s+)?\*\*([^*]+?)\*\*\s*:?\s*$|^\s*#{1,6}\s+([^*].*?)\s*$")
+# Bold text opening a line, possibly after a bullet or number and followed by more text
+BOLD_LEAD_PATTERN = re.compile(r"^\s*(?:[*+-]\s+|\d+[.)]\s+)?\*\*([^*]+?)\*\*")
+# Characters of each other section given as context when one section is regenerated
+SECTION_CONTEXT_CHARS = 100
+
+
+def clean_title(title):
+    """Drops the colon and numbering around a heading's text."""
+    title = title.strip().rstrip(":").strip()
+    return re.sub(r"^\d+[.)]\s*", "", title) # "3. Engage" is the Engage section
+
+
+def lesson_section_name(title):
+    """Returns the lesson section a title names ("Engage (10 minutes)" names Engage), or None."""
+    folded = title.casefold()
+    for name, _ in LESSON_SECTIONS:
+        if folded.startswith(name.casefold()) and not folded[len(name):len(name) + 1].isalnum():
+            return name
+    return None
+
+
+def section_title(line, seen = ()):
+    """Returns the title if a line is a heading, otherwise None.
+
+    Headings are # lines and lines that are all bold. A bold lesson section name opening a bullet or followed by
+    text ("*   **Engage** (...)", "**Engage:** ...") is one too, unless that section is in seen (casefolded names):
+    a later mention, e.g. in the lesson procedure, belongs to the section it appears in.
+    """
+    match = SECTION_HEADING_PATTERN.match(line)
+    if match:
+        return clean_title(match.group(1) or match.group(2))
+    match = BOLD_LEAD_PATTERN.match(line)
+    if not match:
+        return None
+    title = clean_title(match.group(1))
+    name = lesson_section_name(title)
+    return title if name is not None and name.casefold() not in seen else None
+
+
+class LessonDocument:
+    """Markdown output split into sections at its heading lines, so one section can be replaced on its own.
+
+    Each section is a dict with its title ("" for any text before the first heading) and its text, heading line
+    included. Joining the texts gives back the markdown exactly. Parsed spans are kept per section text, so after
+    a replacement only the new section is parsed again.
+    """
+    def __init__(self, text):
+        self.sections = []
+        seen = set()
+        for line in text.splitlines(keepends = True):
+            title = section_title(line, seen)
+            if title:
+                seen.add((lesson_section_name(title) or title).casefold())
+            if title is not None or not self.sections:
+                self.sections.append({"title": title or "", "text": ""})
+            self.sections[-1]["text"] += line
+        self._spans = {}
+
+    def text(self):
+        return "".join(section["text"] for section in self.sections)
+
+    def titles(self):
+        """Titles of the sections that can be regenerated."""
+        return [section["title"] for section in self.sections if section["title"]]
+
+    def find(self, title):
+        """Returns the index of the section with a title (ignoring case), or None."""
+        for index, section in enumerate(self.sections):
+            if section["title"] and section["title"].casefold() == title.casefold():
+                return index
+        return None
+
+    def replace(self, index, text):
+        """Replaces a section's text, keeping the blank lines that separated it from the next section."""
+        old = self.sections[index]["text"]
+        spacing = old[len(old.rstrip("\n")):] if index < len(self.sections) - 1 else ""
+        self.sections[index] = {"title": section_title(text.split("\n", 1)[0]) or self.sections[index]["title"],
+                                "text": text.rstrip("\n") + (spacing or "\n")}
+
+    def spans(self, index):
+        """Parsed spans of one section, which concatenated render the same as the whole document."""
+        text = self.sections[index]["text"]
+        if index < len(self.sections) - 1:
+            text = text[:-1] # parse_markdown ends every line with a newline itself
+        spans = self._spans.get(text)
+        if spans is None:
+            spans = self._spans[text] = parse_markdown(text)
+        return spans
+
+    def context(self, index, limit = SECTION_CONTEXT_CHARS):
+        """Compact summary of every other section, one line each, for regenerating the section at index."""
+        lines = []
+        for other, section in enumerate(self.sections):
+            if other == index or not section["title"]:
+                continue
+            heading, _, body = section["text"].partition("\n")
+            lead = BOLD_LEAD_PATTERN.match(heading)
+            if lead and not SECTION_HEADING_PATTERN.match(heading): # Text after "**Engage:**" on the heading line
+                body = heading[lead.end():].lstrip(" :") + "\n" + body
+            body = " ".join(body.replace("*", "").replace("#", "").split())
+            if len(body) > limit:
+                body = body[:limit] + "..."
+            lines.append(f"- {section['title']}: {body}" if body else f"- {section['title']}")
+        return "\n".join(lines)
+
+
+class SectionedDocx:
+    """DOCX export of a LessonDocument that rebuilds only the paragraphs of sections changed since the last save."""
+    def __init__(self):
+        self.document = None
+        self.texts = [] # Section texts the paragraphs were built from
+        self.paragraphs = [] # Paragraphs of each section
+        self._lock = threading.Lock()
+
+    def update(self, lesson):
+        """Brings the document in line with a lesson, returning how many sections had to be rebuilt."""
+        texts = [section["text"] for section in lesson.sections]
+        if self.document is None or len(texts) != len(self.texts):
+            self.document = new_document()
+            self.paragraphs = [add_spans_to_document(self.document, lesson.spans(index)) for index in range(len(texts))]
+            self.texts = texts
+            return len(texts)
+        changed = 0
+        for index, text in enumerate(texts):
+            if text != self.texts[index]:
+                # New paragraphs are added at the end of the body, then moved in front of the ones they replace
+                paragraphs = add_spans_to_document(self.document, lesson.spans(index))
+                anchor = self.paragraphs[index][0]._p
+                for paragraph in paragraphs:
+                    anchor.addprevious(paragraph._p)
+                for paragraph in self.paragraphs[index]:
+                    paragraph._p.getparent().remove(paragraph._p)
+                self.paragraphs[index] = paragraphs
+                changed += 1
+        self.texts = texts
+        return changed
+
+    def save(self, lesson, file_path, details = None):
+        """Updates the document from the lesson and saves it."""
+        with self._lock, instrumentation.span("export", details):
+            changed = self.update(lesson)
+            self.document.save(file_path)
+        return changed
+
+
+# Response cache
+def normalize_prompt(prompt):
+    """Collapses whitespace and case so trivially different prompts share a cache entry."""
+    return " ".join(prompt.split()).casefold()
+
+
+def cache_key(prompt, model_name = MODEL_NAME, language = "English"):
+    """Returns the cache key for a prompt, model and output language."""
+    key_text = "\x1f".join((model_name, language, normalize_prompt(prompt)))
+    return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Persistent SQLite cache of generated outputs with size and age based eviction.
+
+    Segment translations are kept apart in self.translations, a SegmentCache with its own size limit and
+    counters, so translating lessons never evicts whole outputs or skews their statistics.
+    """
+    TABLE = "responses"
+
+    def __init__(self, path = CACHE_PATH, max_entries = 2000, ttl_seconds = 30 * 24 * 3600, translation_entries = 50000):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock() # One connection shared by the GUI and worker threads
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.TABLE} ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_accessed ON {self.TABLE} (accessed)")
+        self.translations = SegmentCache(path, translation_entries, ttl_seconds) if translation_entries else None
+
+    def get(self, key):
+        """Returns the cached response for a key, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(f"SELECT response, created FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._connection.execute(f"DELETE FROM {self.TABLE} WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._connection.execute(f"UPDATE {self.TABLE} SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        """Stores a response, evicting expired and least recently used entries past the size limit."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.TABLE} (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._connection.execute(f"DELETE FROM {self.TABLE} WHERE created < ?", (now - self.ttl_seconds,))
+            count = self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+            if count > self.max_entries:
+                self._connection.execute(
+                    f"DELETE FROM {self.TABLE} WHERE key IN (SELECT key FROM {self.TABLE} ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def clear(self):
+        """Removes every cached response and resets the counters."""
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.TABLE}")
+            self.hits = 0
+            self.misses = 0
+        if self.translations is not None:
+            self.translations.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of stored entries."""
+        with self._lock:
+            entries = self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+        if self.translations is not None:
+            self.translations.close()
+
+
+class SegmentCache(ResponseCache):
+    """Translated segments, stored next to the response cache in a table of their own."""
+    TABLE = "translations"
+
+    def __init__(self, path = CACHE_PATH, max_entries = 50000, ttl_seconds = 30 * 24 * 3600):
+        super().__init__(path, max_entries, ttl_seconds, translation_entries = 0)
+
+
+def get_response_cache():
+    """Opens the shared response cache the first time it is needed."""
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache()
+    return response_cache
+
+
+# Generation history
+def split_outcomes(outcomes):
+    """Splits learning outcomes as the history stores them, joined with ", "."""
+    return (outcomes or "").split(", ")
+
+
+def entry_request(entry):
+    """Returns the request a history entry was generated for."""
+    return make_request(entry["topic"], split_outcomes(entry["outcomes"]), entry["age_group"], entry["output_type"],
+                        entry["time_minutes"], entry["location_name"], entry["language"])
+
+
+class HistoryStore:
+    """Persistent SQLite record of every generation, with full-text search over topics and outputs.
+
+    Outputs cut off at the output token limit are kept too, marked truncated.
+    """
+    COLUMNS = ("id", "created", "topic", "outcomes", "age_group", "output_type", "time_minutes", "location_name",
+               "language", "model", "output", "elapsed", "prompt_tokens", "output_tokens", "truncated")
+    SUMMARY_COLUMNS = ("id", "created", "topic", "age_group", "output_type", "language", "truncated")
+
+    def __init__(self, path = HISTORY_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY, created REAL NOT NULL, topic TEXT NOT NULL, outcomes TEXT, age_group TEXT, "
+                "output_type TEXT, time_minutes INTEGER, location_name TEXT, language TEXT, model TEXT, "
+                "output TEXT NOT NULL, elapsed REAL, prompt_tokens INTEGER, output_tokens INTEGER, "
+                "truncated INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(history)")]
+            if "truncated" not in columns: # History written before outputs were marked
+                self._connection.execute("ALTER TABLE history ADD COLUMN truncated INTEGER NOT NULL DEFAULT 0")
+            # External content index, so outputs are not stored twice
+            self._connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_search "
+                "USING fts5(topic, output, content='history', content_rowid='id')"
+            )
+            self._connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN "
+                "INSERT INTO history_search (rowid, topic, output) VALUES (new.id, new.topic, new.output); END"
+            )
+            self._connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN "
+                "INSERT INTO history_search (history_search, rowid, topic, output) "
+                "VALUES ('delete', old.id, old.topic, old.output); END"
+            )
+
+    def add(self, request, output, details = None):
+        """Records a generation and returns its id. request holds the inputs, details the timing and token counts."""
+        details = details or {}
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO history (created, topic, outcomes, age_group, output_type, time_minutes, location_name, "
+                "language, model, output, elapsed, prompt_tokens, output_tokens, truncated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), request["topic"], ", ".join(request["outcomes"]), request["age_group"], request["output_type"],
+                 request["time_minutes"], request["location_name"], request["language"], model_name(), output,
+                 details.get("elapsed"), details.get("prompt_tokens"), details.get("output_tokens"),
+                 int(bool(details.get("truncated")))),
+            )
+            return cursor.lastrowid
+
+    @staticmethod
+    def match_expression(query):
+        """Turns free text into an FTS5 query matching every word as a prefix."""
+        words = query.split()
+        return " ".join('"%s"*' % word.replace('"', '""') for word in words)
+
+    def page(self, query = "", before_id = None, limit = 50):
+        """Returns up to limit summary rows, newest first, older than before_id and matching the search query.
+
+        Pages are found by id rather than by offset, so every page is equally fast however deep it is.
+        """
+        columns = ", ".join(self.SUMMARY_COLUMNS)
+        before = -1 if before_id is None else int(before_id)
+        if query.strip():
+            # Let the full-text index walk its matches newest first, then look up only the rows on this page
+            sql = (f"SELECT {columns} FROM history WHERE id IN (SELECT rowid FROM history_search "
+                   "WHERE history_search MATCH ? AND (? < 0 OR rowid < ?) ORDER BY rowid DESC LIMIT ?) ORDER BY id DESC")
+            parameters = (self.match_expression(query), before, before, limit)
+        else:
+            sql = f"SELECT {columns} FROM history WHERE (? < 0 OR id < ?) ORDER BY id DESC LIMIT ?"
+            parameters = (before, before, limit)
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [dict(zip(self.SUMMARY_COLUMNS, row)) for row in rows]
+
+    def count(self, query = ""):
+        """Returns how many entries match the search query (all entries without one)."""
+        with self._lock:
+            if query.strip():
+                return self._connection.execute(
+                    "SELECT COUNT(*) FROM history_search WHERE history_search MATCH ?", (self.match_expression(query),)
+                ).fetchone()[0]
+            return self._connection.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def get(self, entry_id):
+        """Returns the full entry for an id, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM history WHERE id = ?", (entry_id,)
+            ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def iter_requests(self, batch_size = 1000):
+        """Yields (id, request) for every complete (not truncated) entry, oldest first, a page at a time."""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, topic, outcomes, age_group, output_type, time_minutes, location_name, language "
+                    "FROM history WHERE id > ? AND NOT truncated ORDER BY id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], make_request(row[1], split_outcomes(row[2]), *row[3:])
+            last_id = rows[-1][0]
+
+    def iter_outputs(self, query = "", batch_size = 100):
+        """Yields (title, output) for every matching entry, newest first, reading the database a page at a time."""
+        before_id = None
+        while True:
+            rows = self.page(query, before_id, batch_size)
+            if not rows:
+                return
+            for row in rows:
+                entry = self.get(row["id"])
+                yield f"{entry['topic']} ({entry['language']})", entry["output"]
+            before_id = rows[-1]["id"]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_history_store():
+    """Opens the shared history store the first time it is needed."""
+    global history_store
+    if history_store is None:
+        history_store = HistoryStore()
+    return history_store
+
+
+# Similar past lessons
+STOP_WORDS = frozenset("a an and are as at be by can for from how in into is it of on or the their they to what "
+                       "with".split())
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+
+def similarity_terms(topic, learning_outcomes):
+    """Returns the weighted words describing a request, topic words counting double."""
+    if not isinstance(learning_outcomes, str):
+        learning_outcomes = " ".join(learning_outcomes)
+    terms = {}
+    for text, weight in ((topic, 2.0), (learning_outcomes, 1.0)):
+        for word in WORD_PATTERN.findall(text.casefold()):
+            if word in STOP_WORDS:
+                continue
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1] # "plants" and "plant" are the same word here
+            terms[word] = terms.get(word, 0.0) + weight
+    return terms
+
+
+def age_range(age_group):
+    """Returns the (youngest, oldest) ages in an age group such as "10" or "10-12", or None."""
+    ages = [int(age) for age in re.findall(r"\d+", str(age_group))]
+    return (min(ages), max(ages)) if ages else None
+
+
+def similarity_location(request):
+    """Returns the location a request's output depends on: lesson plans describe it, ideas do not."""
+    if request["output_type"] != "Lesson Plan":
+        return ""
+    return " ".join(str(request["location_name"] or "").casefold().split())
+
+
+class SimilarityIndex:
+    """In-memory TF-IDF index of past requests, for finding near-duplicates without calling the model.
+
+    Requests are only compared with past ones for the same output type and language, overlapping or adjacent
+    ages, about the same class time and, for lesson plans, the same location. Among those, the score is the cosine similarity of their topic and
+    learning outcome words. Lookups only score entries sharing the request's rarest words, so they stay fast as
+    the history grows.
+    """
+    def __init__(self, max_candidates = 2000):
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._postings = {} # (output type, language, word) -> {entry id: weight}
+        self._sizes = {} # (output type, language) -> number of entries
+        self._entries = {} # entry id -> (terms, ages, time, topic, age group, location)
+        self._norms = {} # entry id -> (group size when computed, vector length)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry_id, request):
+        """Adds a past request under its history id."""
+        group = (request["output_type"], request["language"])
+        terms = similarity_terms(request["topic"], request["outcomes"])
+        with self._lock:
+            if entry_id in self._entries:
+                return
+            self._entries[entry_id] = (terms, age_range(request["age_group"]), request["time_minutes"], request["topic"],
+                                       request["age_group"], similarity_location(request))
+            self._sizes[group] = self._sizes.get(group, 0) + 1
+            for word, weight in terms.items():
+                self._postings.setdefault(group + (word,), {})[entry_id] = weight
+
+    def load(self, store):
+        """Adds every request in a history store."""
+        for entry_id, request in store.iter_requests():
+            self.add(entry_id, request)
+        return self
+
+    @staticmethod
+    def compatible(ages, time_minutes, location, entry):
+        """Checks whether a past entry was for about the same learners, class time and location."""
+        _, entry_ages, entry_time, _, _, entry_location = entry
+        if location != entry_location:
+            return False
+        if ages and entry_ages:
+            if ages[0] > entry_ages[1] + 1 or entry_ages[0] > ages[1] + 1:
+                return False
+        elif ages or entry_ages:
+            return False
+        if time_minutes and entry_time:
+            return abs(int(time_minutes) - int(entry_time)) <= 0.25 * max(int(time_minutes), int(entry_time))
+        return not time_minutes and not entry_time
+
+    def search(self, request, limit = 5, min_score = SIMILAR_SUGGEST):
+        """Returns up to limit past entries similar to a request, best first, as dicts with id, score and topic."""
+        group = (request["output_type"], request["language"])
+        terms = similarity_terms(request["topic"], request["outcomes"])
+        ages = age_range(request["age_group"])
+        location = similarity_location(request)
+        with self._lock:
+            size = self._sizes.get(group, 0)
+            if not size or not terms:
+                return []
+            postings = {word: self._postings.get(group + (word,), {}) for word in terms}
+            idfs = {}
+
+            def idf(word):
+                value = idfs.get(word)
+                if value is None:
+                    value = idfs[word] = math.log((size + 1) / (len(self._postings.get(group + (word,), ())) + 1)) + 1
+                return value
+
+            weights = {word: weight * idf(word) for word, weight in terms.items()}
+            query_norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            factors = {word: weight * idf(word) for word, weight in weights.items()}
+            # Entries sharing the request's rarest words are the only ones that can be close to it
+            candidates = set()
+            for word in sorted(terms, key=lambda word: len(postings[word])):
+                if len(candidates) >= self.max_candidates:
+                    break
+                candidates.update(postings[word])
+            results = []
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if not self.compatible(ages, request["time_minutes"], location, entry):
+                    continue
+                entry_terms = entry[0]
+                dot = 0.0
+                for word, factor in factors.items():
+                    weight = entry_terms.get(word)
+                    if weight:
+                        dot += factor * weight
+                # Norms depend on how common words are, so they are recomputed once the group has grown by a tenth
+                cached = self._norms.get(entry_id)
+                if cached is None or size > cached[0] * 1.1:
+                    cached = self._norms[entry_id] = (size, math.sqrt(sum((weight * idf(word)) ** 2
+                                                                          for word, weight in entry_terms.items())))
+                score = dot / (query_norm * cached[1])
+                if score >= min_score:
+                    results.append({"id": entry_id, "score": round(min(score, 1.0), 3), "topic": entry[3],
+                                    "age_group": entry[4], "time_minutes": entry[2]})
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return results[:limit]
+
+
+def load_similarity_index():
+    """Builds the similarity index from the history the first time it is needed."""
+    global similarity_index
+    with similarity_lock:
+        if similarity_index is None:
+            with instrumentation.span("similarity_build"):
+                similarity_index = SimilarityIndex().load(get_history_store())
+        return similarity_index
+
+
+# Model backends
+class ModelBackend(ABC):
+    """Something that writes text for prompts in place of Gemini.
+
+    Responses are cached under the backend's name, so they never mix with Gemini's.
+    """
+    name = None
+
+    @abstractmethod
+    def generate_content(self, prompt, stream = False, generation_config = None):
+        """Returns a response with a text attribute, or with stream=True an iterable of such chunks, like a Gemini model.
+
+        Responses may also carry usage_metadata with token counts and candidates with a finish_reason.
+        generation_config may carry max_output_tokens.
+        """
+
+
+class BackendError(Exception):
+    """Error from a local backend, carrying an HTTP-like status code as Google API errors do."""
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class UsageMetadata:
+    """Token counts of a response, named like Gemini's."""
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class Candidate:
+    """Mimics a Gemini response candidate, which says why the model stopped writing."""
+    def __init__(self, finish_reason = "STOP"):
+        self.finish_reason = finish_reason
+
+
+class StubResponse:
+    """Mimics the part of a Gemini response that the generator reads."""
+    def __init__(self, text, usage_metadata = None, finish_reason = "STOP"):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self.candidates = [Candidate(finish_reason)]
+
+    def __iter__(self):
+        yield self # A non-streamed response is a single chunk
+
+
+class StubModel(ModelBackend):
+    """Local stand-in for the Gemini model, used to try out batch runs without an API key."""
+    name = "stub"
+
+    def __init__(self, delay = 0.5):
+        self.delay = delay
+
+    def generate_content(self, prompt, stream = False, generation_config = None):
+        text = f"**Stub Output**\n*Generated locally for a prompt of {len(prompt)} characters.*\n"
+        if stream:
+            return self.stream_content(text)
+        time.sleep(self.delay) # Pretend to wait for the network
+        return StubResponse(text)
+
+    def stream_content(self, text):
+        words = text.split(" ")
+        for word in words:
+            time.sleep(self.delay / len(words))
+            yield StubResponse(word + " ")
+
+
+class FakeBackend(ModelBackend):
+    """Deterministic local stand-in for Gemini, for measuring the app without an API key or network.
+
+    Each response waits latency seconds, then seconds_per_word for every word written, and holds about words
+    words of lesson-like markdown. At failure_rate, calls fail with a transient 429 or 503 instead. The same seed
+    gives the same sequence of failures, and the same prompt always gives the same text.
+    """
+    name = "fake"
+    HEADINGS = ["Engage", "Explore", "Explain", "Elaborate", "Evaluate", "Materials Needed", "STEAM Integration"]
+    WORDS = ["students", "observe", "measure", "build", "compare", "record", "discuss", "design", "model", "test",
+             "sketch", "predict", "explain", "share", "materials", "results", "pattern", "question", "team", "data"]
+
+    def __init__(self, latency = 0.2, seconds_per_word = 0.0, words = 600, failure_rate = 0.0, seed = 0):
+        self.latency = latency
+        self.seconds_per_word = seconds_per_word
+        self.words = int(words)
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def write(self, prompt, words):
+        """Returns words words of text for a prompt, the same every time."""
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        lines = ["**Fake Output**", ""]
+        written = 0
+        section = 0
+        while written < words:
+            lines.append(f"**{self.HEADINGS[section % len(self.HEADINGS)]}**")
+            for _ in range(4):
+                count = min(20, words - written)
+                if count <= 0:
+                    break
+                sentence = " ".join(rng.choice(self.WORDS) for _ in range(count))
+                lines.append(f"*   *Step {section + 1}:* {sentence}.")
+                written += count
+            lines.append("")
+            section += 1
+        return "\n".join(lines)
+
+    def generate_content(self, prompt, stream = False, generation_config = None):
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.failure_rate
+            code = self._random.choice((429, 503))
+        if failed:
+            time.sleep(self.latency)
+            raise BackendError(code, "Resource has been exhausted (e.g. check quota)." if code == 429 else "Service unavailable.")
+        words = self.words
+        text = self.write(prompt, words)
+        limit = (generation_config or {}).get("max_output_tokens")
+        finish_reason = "STOP"
+        if limit and estimate_tokens(text) > limit:
+            text = text[:limit * 4] # Cut off at the token limit, as Gemini does
+            words = len(text.split())
+            finish_reason = "MAX_TOKENS"
+        usage = UsageMetadata(estimate_tokens(prompt), estimate_tokens(text))
+        if stream:
+            return self.stream_content(text, usage, finish_reason)
+        time.sleep(self.latency + words * self.seconds_per_word)
+        return StubResponse(text, usage, finish_reason)
+
+    def stream_content(self, text, usage, finish_reason = "STOP"):
+        time.sleep(self.latency)
+        lines = text.split("\n")
+        for index, line in enumerate(lines):
+            time.sleep(len(line.split()) * self.seconds_per_word)
+            if index < len(lines) - 1:
+                yield StubResponse(line + "\n", finish_reason = None)
+            else:
+                yield StubResponse(line, usage, finish_reason) # The last chunk carries the totals and the finish reason
+
+
+# Backends that can be chosen with --backend, by name
+MODEL_BACKENDS = {"stub": StubModel, "fake": FakeBackend}
+
+
+def make_backend(spec):
+    """Builds a backend from a spec such as "stub" or "fake:latency=0.5,words=800,failure_rate=0.1".
+
+    Returns None for "gemini". Raises ValueError for unknown backends or options.
+    """
+    name, _, options = spec.partition(":")
+    name = name.strip().lower()
+    if name in ("", "gemini"):
+        return None
+    if name not in MODEL_BACKENDS:
+        raise ValueError(f"unknown backend {name!r}, choose from: gemini, {', '.join(MODEL_BACKENDS)}")
+    settings = {}
+    for option in filter(None, (option.strip() for option in options.split(","))):
+        key, _, value = option.partition("=")
+        try:
+            settings[key.strip().replace("-", "_")] = float(value)
+        except ValueError:
+            raise ValueError(f"backend option {option!r} must look like name=number")
+    try:
+        return MODEL_BACKENDS[name](**settings)
+    except TypeError as e:
+        raise ValueError(f"bad options for the {name} backend: {e}")
+
+
+def use_backend(backend):
+    """Makes every generation that is not given a model use this backend (None for Gemini)."""
+    global model_backend
+    model_backend = backend
+
+
+def model_name(model = None):
+    """Returns the name outputs are cached and recorded under: the given model's, the backend's or Gemini's."""
+    model = model if model is not None else model_backend
+    return getattr(model, "name", None) or MODEL_NAME
+
+
+# Batch generation
+def read_batch_rows(path):
+    """Reads lesson rows one at a time from a CSV or JSONL file.
+
+    A row that cannot be parsed is yielded as the ValueError describing it, so the rows around it still run.
+    A CSV file that cannot be decoded stops at that row, since the rows after it cannot be found reliably.
+    """
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path, "rb") as batch_file:
+            for line in batch_file:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e: # Also covers lines that are not UTF-8
+                    yield ValueError(f"not valid JSON: {e}")
+                    continue
+                yield row if isinstance(row, dict) else ValueError("each line must be a JSON object")
+        return
+    with open(path, "rb") as batch_file:
+        # Decoded per line, so earlier rows survive a bad byte; utf-8-sig drops the BOM of Excel's "CSV UTF-8"
+        reader = csv.DictReader(line.decode("utf-8-sig") for line in batch_file)
+        while True:
+            try:
+                yield next(reader)
+            except StopIteration:
+                return
+            except UnicodeDecodeError as e:
+                yield ValueError(f"the file is not UTF-8 ({e}), rows after this one were not read")
+                return
+            except csv.Error as e:
+                yield ValueError(f"not valid CSV: {e}")
+
+
+def process_batch_row(index, row, model, cache = None):
+    """Generates the output for a single batch row and returns a result record."""
+    started = time.perf_counter()
+    result = {"index": index, "topic": row.get("topic", ""), "output": None, "error": None}
+    details = {}
+    try:
+        request = parse_request(row)
+        result.update(request)
+        text = generate_output(request["topic"], request["outcomes"], request["age_group"], request["output_type"],
+                               request["time_minutes"], request["location_name"], request["language"],
+                               model = model, cache = cache, details = details)
+        if text.startswith("Error"):
+            result["error"] = text
+        else:
+            result["output"] = text
+    except Exception as e:
+        result["error"] = f"Error in row {index}: {e}"
+    result["elapsed"] = round(time.perf_counter() - started, 3)
+    result["tokens"] = token_counts(details)
+    result["truncated"] = bool(details.get("truncated")) # Cut off at the output token limit
+    return result
+
+
+def run_batch(input_path, output_path, workers = 4, max_pending = None, model = None, cache = None, progress = None):
+    """Generates every row of the input file with a pool of workers, writing results as JSON lines as they finish.
+
+    At most max_pending rows are read ahead of the finished ones, so memory stays flat however long the file is.
+    Rows that cannot be parsed are written as {"index", "error"} records. If the run stops early (an unreadable
+    file, Ctrl+C), the rows already started are still finished and written before the error is raised.
+    """
+    if model is None:
+        model = create_model()
+    max_pending = max_pending or workers * 2
+    counts = {"done": 0, "failed": 0}
+
+    def write_result(result):
+        output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_file.flush()
+        counts["done"] += 1
+        if result["error"]:
+            counts["failed"] += 1
+        if progress:
+            progress(counts["done"], counts["failed"], result)
+
+    with open(output_path, "w", encoding="utf-8") as output_file, ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        try:
+            for index, row in enumerate(read_batch_rows(input_path)):
+                if isinstance(row, ValueError):
+                    write_result({"index": index, "error": f"Error in row {index}: {row}"})
+                    continue
+                if len(pending) >= max_pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        write_result(future.result())
+                pending.add(pool.submit(process_batch_row, index, row, model, cache))
+        finally:
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write_result(future.result())
+    return counts
+
+
+# Background jobs
+class Job:
+    """A generation started from the GUI. Its fields are only changed on the Tk main loop."""
+    def __init__(self, job_id, title, request = None):
+        self.id = job_id
+        self.title = title
+        self.request = request
+        self.status = "queued" # queued, running, done, failed or cancelled
+        self.progress = ""
+        self.output = "" # Markdown received so far
+        self.error = None
+        self.details = {} # Filled in by the worker, read once the job has finished
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+
+class JobManager:
+    """Runs jobs on a worker pool, handing everything they report to the main loop through a queue.
+
+    Workers never touch Tk widgets. A job's work(job, emit) runs in the pool and calls emit(kind, value) with
+    "chunk" (more output), "progress" (a status message) or any other event for the GUI, then returns the whole
+    output. poll(), called from window.after, applies the queued events to the jobs on the main loop and returns
+    them for the GUI to show.
+    """
+    def __init__(self, max_workers = 4):
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.events = queue.Queue()
+        self.jobs = {}
+        self._next_id = 1
+
+    def submit(self, title, work, request = None):
+        """Queues work(job, emit) and returns its job."""
+        job = Job(self._next_id, title, request)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job, work)
+        return job
+
+    def _run(self, job, work):
+        self.events.put((job, "running", None))
+        try:
+            output = work(job, lambda kind, value: self.events.put((job, kind, value)))
+        except Exception as e:
+            output = f"Error generating STEAM ideas: {e}"
+        if job.cancel_event.is_set():
+            self.events.put((job, "cancelled", None))
+        elif output.startswith("Error"):
+            self.events.put((job, "failed", output))
+        else:
+            self.events.put((job, "done", output))
+
+    def cancel(self, job):
+        """Asks a job to stop, it is cancelled straight away if it has not started yet."""
+        job.cancel_event.set()
+        if job.future.cancel():
+            self.events.put((job, "cancelled", None))
+
+    def cancel_all(self):
+        for job in self.jobs.values():
+            if not job.finished():
+                self.cancel(job)
+
+    def active(self):
+        """Checks whether any job is unfinished or has events waiting."""
+        return not self.events.empty() or any(not job.finished() for job in self.jobs.values())
+
+    def poll(self, budget = 0.008):
+        """Applies queued events on the calling thread and returns them as (job, kind, value) tuples.
+
+        Stops after budget seconds so a burst of events never holds up a frame, the rest wait for the next poll.
+        """
+        applied = []
+        stop = time.perf_counter() + budget
+        while time.perf_counter() < stop:
+            try:
+                job, kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if job.finished():
+                continue # Cancelled before it could start, or a late event after cancelling
+            if kind == "running":
+                job.status = "running"
+            elif kind == "chunk":
+                job.output += value
+            elif kind == "progress":
+                job.progress = value
+            elif kind == "done":
+                job.status = "done"
+                job.output = value
+            elif kind == "failed":
+                job.status = "failed"
+                job.error = value
+            elif kind == "cancelled":
+                job.status = "cancelled"
+            applied.append((job, kind, value))
+        return applied
+
+    def shutdown(self):
+        self.cancel_all()
+        self.executor.shutdown(wait = False)
 
 
 class SteamApp:
     def __init__(self):
         self.window = tk.Tk()
         self.window.title("STEAM Integration Generator")
-        self.window.geometry("1000x750")  # Increased window size
+        self.window.geometry("1000x900")  # Increased window size
         self.window.configure(bg="#f0f0f0")
 
-        # History tracking
-        self.history = deque(maxlen=5)
+        # History window, created on demand
+        self.history_window = None
          # Variables
         self.topic_entry = None
         self.outcomes_entry = None
@@ -84,8 +2499,30 @@ class SteamApp:
         self.time_entry = None
         self.location_entry = None
         self.output_type_var = tk.StringVar()
+        self.bypass_cache_var = tk.BooleanVar(value = False)
+        self.stream_var = tk.BooleanVar(value = True)
+        self.parallel_var = tk.BooleanVar(value = False)
+        self.reuse_similar_var = tk.BooleanVar(value = False)
+        # Generation jobs, and the one shown in the output box (only touched on the Tk main loop)
+        self.jobs = JobManager()
+        self.shown_job = None
+        self.stream_buffer = ""
+        self.polling_jobs = False
+        self.job_list = None
+        self.similar_matches = {} # Job id -> past lessons similar to it
+        # Markdown of the output currently shown, for exports
+        self.output_markdown = ""
+        # The shown output split into sections, the request it was generated for, and whether the output box has a
+        # section<i> mark at the start of each section (set when it is rendered section by section)
+        self.output_document = None
+        self.output_request = None
+        self.section_marks = False
+        self.section_var = tk.StringVar()
+        self.section_combobox = None
+        self.docx_export = SectionedDocx()
         self.loading_animation = None
         self.generate_button = None
+        self.status_label = None
 
         # Styling using ttk
         self.style = ttk.Style()
@@ -97,34 +2534,11 @@ class SteamApp:
         self.api_key = None # Global api key
 
         self.create_widgets()
+        # Build the index of past lessons without holding up the window
+        threading.Thread(target = load_similarity_index, daemon = True).start()
 
-    def generate_steam_ideas(self, topic, learning_outcomes, age_group, output_type, time_minutes = None, location_name = None):
-        """Generates elaborate STEAM integration ideas for a topic."""
-        global api_key
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-pro")
-        prompt = generate_prompt(topic, learning_outcomes, age_group, output_type, time_minutes, location_name)
-
-        try:
-            response = model.generate_content(prompt)
-            if response and response.text:
-                return response.text # Valid response
-            else:
-                return "Error: Could not generate any meaningful output, please try again." # API response is empty or invalid
-        except Exception as e:
-            return f"Error generating STEAM ideas: {e}"
-
-    def translate_text(self, text, target_language):
-        """Translates text using googletrans."""
-        translator = Translator()
-        try:
-            translated = translator.translate(text, dest=target_language)
-            return translated.text
-        except Exception as e:
-            return f"Error in translation: {e}"
-
-    def format_output_text(self, text):
-        """Formats the output text with different styles using tags."""
+    def clear_output_text(self):
+        """Empties the output box and defines the formatting tags."""
         self.output_text.config(state=tk.NORMAL)
         self.output_text.delete(1.0, tk.END)
 
@@ -133,30 +2547,198 @@ class SteamApp:
         self.output_text.tag_config("subheading", font=("Helvetica", 12, "bold"))
         self.output_text.tag_config("italic", font=("Helvetica", 11, "italic"))
 
-        paragraphs = text.split("\n")
-        for paragraph in paragraphs:
-            words = paragraph.split(" ")
-            word_count = 0
-            for word in words:
-              if word_count < 2 and "**" in word:
-                self.output_text.insert(tk.END, word.replace("**",""), "heading")
-                word_count = word_count + 1
-              elif "**" in word:
-                  self.output_text.insert(tk.END, word.replace("**",""), "subheading")
-                  word_count = word_count + 1
-              elif "*" in word:
-                self.output_text.insert(tk.END, word.replace("*",""), "italic")
-                word_count = word_count + 1
-              else:
-                self.output_text.insert(tk.END, word + " ")
-                word_count = word_count + 1
-            self.output_text.insert(tk.END, "\n") #Add new line at the end of each paragraph
-        self.output_text.config(state=tk.DISABLED)
+    def insert_spans(self, spans, index = tk.END):
+        """Inserts parsed spans into the output box (at the end by default) with a single Tk call."""
+        if spans:
+            arguments = []
+            for text, style in spans:
+                arguments.extend((text, style or ()))
+            self.output_text.insert(index, *arguments)
 
-    def update_history(self, topic, outcomes, age_group, language):
-        """Updates the history with current details."""
-        history_entry = f"Topic: {topic}, Outcomes: {', '.join(outcomes)}, Age: {age_group}, Lang: {language}"
-        self.history.append(history_entry)
+    def format_output_text(self, text, details = None, request = None):
+        """Formats the output text with different styles using tags."""
+        with instrumentation.span("render", details):
+            self.output_markdown = text # Kept so exports use the original markup
+            self.output_request = request
+            self.render_document(LessonDocument(text))
+
+    def render_document(self, document):
+        """Renders a document section by section, marking where each section starts so it can be replaced later."""
+        self.clear_output_text()
+        for index in range(len(document.sections)):
+            self.output_text.mark_set(f"section{index}", "end-1c")
+            self.output_text.mark_gravity(f"section{index}", tk.LEFT)
+            self.insert_spans(document.spans(index))
+        self.output_text.config(state=tk.DISABLED)
+        self.set_output_document(document, marked = True)
+
+    def set_output_document(self, document, marked = False):
+        """Keeps the sections of the shown output and offers them for regeneration."""
+        self.output_document = document
+        self.section_marks = marked
+        titles = document.titles() if document is not None else []
+        if self.section_combobox is not None:
+            self.section_combobox.config(values = titles)
+            if self.section_var.get() not in titles:
+                self.section_var.set(titles[0] if titles else "")
+
+    def patch_section(self, index, text):
+        """Replaces one section of the shown output, re-rendering only that section in the output box."""
+        document = self.output_document
+        if not self.section_marks:
+            self.render_document(document) # Output shown while streaming has no section marks yet
+        document.replace(index, text)
+        last = index == len(document.sections) - 1
+        start = f"section{index}"
+        self.output_text.config(state=tk.NORMAL)
+        self.output_text.delete(start, "end-1c" if last else f"section{index + 1}")
+        # The next section's mark collapsed onto the start, so it is moved back after the new text
+        self.output_text.mark_set("patch_end", start)
+        self.output_text.mark_gravity("patch_end", tk.RIGHT)
+        self.insert_spans(document.spans(index), start)
+        if not last:
+            self.output_text.mark_set(f"section{index + 1}", "patch_end")
+        self.output_text.mark_unset("patch_end")
+        self.output_text.config(state=tk.DISABLED)
+        self.output_markdown = document.text()
+        self.set_output_document(document, marked = True)
+
+    def show_job(self, job):
+        """Shows a job's output in the output box, following it as more arrives."""
+        self.shown_job = job
+        self.output_markdown = job.output
+        self.output_request = job.request
+        if job.finished():
+            self.stream_buffer = ""
+            self.render_document(LessonDocument(job.output))
+        else:
+            # Only complete lines are rendered while the job is running
+            self.clear_output_text()
+            complete, _, self.stream_buffer = job.output.rpartition("\n")
+            self.insert_spans(parse_markdown(complete))
+            self.output_text.config(state=tk.DISABLED)
+            self.set_output_document(None)
+
+    def render_chunks(self, job, chunks):
+        """Renders the lines completed by new chunks of the shown job."""
+        self.output_markdown = job.output
+        self.stream_buffer += "".join(chunks)
+        *complete, self.stream_buffer = self.stream_buffer.split("\n")
+        if complete:
+            with instrumentation.span("render", job.details):
+                self.output_text.config(state=tk.NORMAL)
+                self.insert_spans(parse_markdown("\n".join(complete)))
+                self.output_text.config(state=tk.DISABLED)
+
+    def start_polling_jobs(self):
+        if not self.polling_jobs:
+            self.polling_jobs = True
+            self.window.after(16, self.poll_jobs)
+
+    def poll_jobs(self):
+        """Applies what the generation jobs have reported since the last poll, about once per frame."""
+        shown_chunks = []
+        changed = {}
+        for job, kind, value in self.jobs.poll():
+            changed[job.id] = job
+            if kind == "chunk":
+                if job is self.shown_job:
+                    shown_chunks.append(value)
+                continue
+            if shown_chunks and job is self.shown_job:
+                self.render_chunks(job, shown_chunks)
+                shown_chunks = []
+            if kind == "done":
+                self.finish_job(job)
+            elif kind == "similar":
+                self.similar_matches[job.id] = value
+                if job is self.shown_job:
+                    self.set_status(self.describe_similar(value).capitalize())
+            elif kind == "failed":
+                if job is self.shown_job:
+                    messagebox.showerror("Error", job.error)
+                else:
+                    self.set_status(f"{job.title}: {job.error}")
+            if job.finished() and kind != "done":
+                self.similar_matches.pop(job.id, None)
+        if shown_chunks:
+            self.render_chunks(self.shown_job, shown_chunks)
+        for job in changed.values():
+            self.update_job_row(job)
+
+        if self.jobs.active():
+            self.window.after(16, self.poll_jobs)
+        else:
+            self.polling_jobs = False
+
+    def finish_job(self, job):
+        """Records a finished job and completes its output if it is shown."""
+        if job is self.shown_job:
+            with instrumentation.span("render", job.details):
+                if job.details.get("streamed"):
+                    self.output_text.config(state=tk.NORMAL)
+                    self.insert_spans(parse_markdown(self.stream_buffer)) # Last line has no trailing newline
+                    self.output_text.config(state=tk.DISABLED)
+                    self.stream_buffer = ""
+                    self.set_output_document(LessonDocument(job.output))
+                else:
+                    self.show_job(job)
+            self.show_breakdown(job.details, self.similar_matches.get(job.id))
+        self.similar_matches.pop(job.id, None)
+        if "similar_to" not in job.details: # Reused lessons are in the history already
+            self.update_history(job.request, job.output, job.details)
+
+    @staticmethod
+    def describe_similar(matches):
+        described = [f"{match['topic']} ({match['score']:.0%})" for match in matches[:3]]
+        return "similar past lessons: " + ", ".join(described) + " (see History > Similar Past Lessons)"
+
+    def add_job_row(self, job):
+        self.job_list.insert("", 0, iid=str(job.id), values=(job.title, job.status, job.progress))
+        self.job_list.selection_set(str(job.id))
+
+    def update_job_row(self, job):
+        progress = job.progress
+        if job.status == "running" and job.output:
+            progress = f"{len(job.output.split())} words"
+        elif job.status == "done":
+            progress = format_stages(job.details)
+        self.job_list.item(str(job.id), values=(job.title, job.status, progress))
+
+    def select_job(self, event = None):
+        """Shows the job selected in the job list."""
+        selection = self.job_list.selection()
+        if selection:
+            job = self.jobs.jobs.get(int(selection[0]))
+            if job is not None and job is not self.shown_job:
+                self.show_job(job)
+
+    def cancel_selected_job(self):
+        """Cancels the job selected in the job list."""
+        selection = self.job_list.selection()
+        if not selection:
+            messagebox.showwarning("Warning", "Select a job to cancel.")
+            return
+        job = self.jobs.jobs.get(int(selection[0]))
+        if job is not None and not job.finished():
+            self.jobs.cancel(job)
+            job.progress = "Cancelling..."
+            self.update_job_row(job)
+
+    def show_breakdown(self, details, similar = None):
+        """Shows where the last request spent its time in the status line, and any similar past lessons."""
+        breakdown = format_stages(details)
+        if "first_chunk" in details:
+            breakdown += f" · first text after {details['first_chunk']:.2f}s"
+        if similar and "similar_to" not in details:
+            breakdown += " · " + self.describe_similar(similar)
+        self.set_status(f"Last request: {breakdown}")
+
+    def update_history(self, request, output, details):
+        """Records the generation in the persistent history, marked if it was cut off at the output token limit."""
+        entry_id = get_history_store().add(request, output, details)
+        if similarity_index is not None and not details.get("truncated"): # Never reuse a cut off output
+            similarity_index.add(entry_id, request)
 
     def generate_and_display(self):
        """Handles GUI interactions for STEAM generation and language selection."""
@@ -181,37 +2763,45 @@ class SteamApp:
          messagebox.showerror("Error", "Please fill in all fields.")
          return
 
-       # Disable the button while generating output
-       self.generate_button.config(text="Generating, Please Wait...", state=tk.DISABLED)
-
-       def call_api_in_thread():
-            """Call the api in thread so that UI does not freeze"""
-            try:
-                steam_ideas = self.generate_steam_ideas(topic, learning_outcomes, age_group, output_type, time_minutes, location_name)
-                if steam_ideas.startswith("Error"):
-                  messagebox.showerror("Error", steam_ideas)
-                elif language == "Nepali":
-                    translated_ideas = self.translate_text(steam_ideas, 'ne')
-                    if translated_ideas.startswith("Error"):
-                        messagebox.showerror("Error", translated_ideas)
-                    else:
-                        self.format_output_text(translated_ideas)
-                        self.update_history(topic, learning_outcomes, age_group, "Nepali")
-
-                else:
-                    self.format_output_text(steam_ideas)
-                    self.update_history(topic, learning_outcomes, age_group, "English")
-
-            except Exception as e:
-               messagebox.showerror("Error", f"Error during generation, please check inputs and try again. Error: {e}")
-
-            finally:
-               # Re enable button
-               self.generate_button.config(text="Generate STEAM Ideas", state=tk.NORMAL)
+       request = make_request(topic, learning_outcomes, age_group, output_type, time_minutes, location_name, language)
+       cache = None if self.bypass_cache_var.get() else get_response_cache()
+       # Translation needs the whole text, so translated output is not streamed
+       stream = self.stream_var.get() and language not in TRANSLATED_LANGUAGES
+       parallel_sections = self.parallel_var.get()
+       reuse_similar = self.reuse_similar_var.get()
+
+       def generate(job, emit):
+            """Runs in a worker thread, so it reports through emit and never touches the widgets."""
+            started = time.perf_counter()
+            index = similarity_index # None until it has been built
+            matches = index.search(request) if index is not None else []
+            if matches:
+                emit("similar", matches)
+                best = matches[0]
+                entry = get_history_store().get(best["id"]) if reuse_similar and best["score"] >= SIMILAR_REUSE else None
+                if entry:
+                    job.details.update(similar_to = best["id"], similarity = best["score"])
+                    return entry["output"]
+            if stream:
+                job.details["streamed"] = True
+                chunks = []
+                for chunk in stream_output(topic, learning_outcomes, age_group, output_type, time_minutes, location_name,
+                                           language, cache = cache, details = job.details, cancel_event = job.cancel_event,
+                                           parallel_sections = parallel_sections):
+                    chunks.append(chunk)
+                    emit("chunk", chunk)
+                output = "".join(chunks) or "Error: Could not generate any meaningful output, please try again."
+            else:
+                output = generate_output(topic, learning_outcomes, age_group, output_type, time_minutes, location_name,
+                                         language, cache = cache, details = job.details, cancel_event = job.cancel_event,
+                                         parallel_sections = parallel_sections, progress = lambda text: emit("progress", text))
+            job.details["elapsed"] = round(time.perf_counter() - started, 3)
+            return output
 
-       # Use thread to call api
-       thread = threading.Thread(target = call_api_in_thread)
-       thread.start()
+       job = self.jobs.submit(f"{topic} ({output_type}, {language})", generate, request)
+       self.add_job_row(job)
+       self.show_job(job)
+       self.start_polling_jobs()
 
     def clear_all(self):
         """Clears all input and output fields."""
@@ -221,12 +2811,50 @@ class SteamApp:
         self.output_text.config(state=tk.NORMAL)
         self.output_text.delete(1.0, tk.END)
         self.output_text.config(state=tk.DISABLED)
+        self.output_markdown = ""
+        self.output_request = None
+        self.set_output_document(None)
+        self.shown_job = None
         if self.time_entry:
           self.time_entry.delete(0,tk.END)
         if self.location_entry:
           self.location_entry.delete(0, tk.END)
 
 
+    def regenerate_selected_section(self):
+        """Regenerates the section picked in the section box and patches it into the output in place."""
+        document = self.output_document
+        index = document.find(self.section_var.get()) if document is not None else None
+        if index is None:
+            messagebox.showwarning("Warning", "Generate a lesson first, then pick the section to regenerate.")
+            return
+        request = self.output_request
+        if request is None:
+            messagebox.showwarning("Warning", "This output has no lesson details to regenerate it from.")
+            return
+        title = document.sections[index]["title"]
+        before = document.sections[index]["text"]
+        cache = None if self.bypass_cache_var.get() else get_response_cache()
+        details = {}
+        self.set_status(f"Regenerating {title}...")
+
+        def regenerate_done(result, error):
+            if error:
+                self.set_status("")
+                messagebox.showerror("Error", f"Failed to regenerate {title}: {error}")
+            elif self.output_document is not document or document.sections[index]["text"] != before:
+                self.set_status(f"The output changed while {title} was being regenerated, the new version was dropped.")
+            else:
+                with instrumentation.span("render", details):
+                    self.patch_section(index, result)
+                if self.shown_job is not None:
+                    self.shown_job.output = self.output_markdown
+                self.update_history(request, self.output_markdown, details)
+                self.set_status(f"Regenerated {title}: {format_stages(details)}")
+
+        self.run_in_background(lambda report: regenerate_section(request, document, index, cache = cache, details = details),
+                               regenerate_done)
+
     def export_to_docx(self):
         """Exports the generated STEAM ideas to a DOCX file with formatting."""
         steam_text = self.output_text.get(1.0, tk.END).strip()
@@ -238,42 +2866,96 @@ class SteamApp:
             defaultextension=".docx", filetypes=[("Word Document", "*.docx")]
         )
         if file_path:
+            markdown = self.output_markdown.strip() or steam_text
+            document = self.output_document
+            self.set_status("Exporting to DOCX...")
+            details = {}
+
+            def export_done(result, error):
+                self.set_status(f"Last export: {format_stages(details)}")
+                if error:
+                    messagebox.showerror("Error", f"Failed to export STEAM ideas: {error}")
+                else:
+                    messagebox.showinfo("Success", "STEAM ideas exported successfully.")
+
+            # Build and save the document off the main thread so the window stays responsive
+            if document is not None and document.text().strip() == markdown:
+                # Sections unchanged since the last export keep their paragraphs
+                self.run_in_background(lambda report: self.docx_export.save(document, file_path, details), export_done)
+            else:
+                self.run_in_background(lambda report: write_docx(markdown, file_path, details), export_done)
+
+    def bulk_export(self, items, description):
+        """Exports many lessons to one combined DOCX or a zip of DOCX files in the background."""
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".docx",
+            filetypes=[("Word Document (all lessons)", "*.docx"), ("Zip of Word Documents", "*.zip")],
+        )
+        if not file_path:
+            return
+        self.set_status(f"Exporting {description}...")
+
+        def export_progress(count):
+            self.set_status(f"Exporting {description}: {count} lessons written...")
+
+        def export_done(count, error):
+            self.set_status("")
+            if error:
+                messagebox.showerror("Error", f"Failed to export lessons: {error}")
+            else:
+                messagebox.showinfo("Success", f"Exported {count} lessons to {os.path.basename(file_path)}.")
+
+        self.run_in_background(lambda report: export_lessons(items, file_path, report), export_done, export_progress)
+
+    def export_history(self, query = ""):
+        """Exports every lesson in the history, or only those matching a search."""
+        store = get_history_store()
+        if not store.count(query):
+            messagebox.showwarning("Warning", "No lessons in the history to export.")
+            return
+        self.bulk_export(store.iter_outputs(query), "history")
+
+    def export_batch_results(self):
+        """Exports every successful lesson from a batch results file."""
+        results_path = filedialog.askopenfilename(filetypes=[("Batch Results", "*.jsonl"), ("All Files", "*.*")])
+        if results_path:
+            self.bulk_export(read_batch_results(results_path), "batch results")
+
+    def set_status(self, text):
+        """Shows a short message in the status line under the output box."""
+        self.status_label.config(text=text)
+
+    def run_in_background(self, work, on_done, on_progress = None):
+        """Runs work(report) in a worker thread, delivering report() calls and the result to callbacks on the main loop.
+
+        on_done is called with (result, error), where error is None if the work succeeded.
+        """
+        events = queue.Queue()
+
+        def worker():
             try:
-                document = Document()
-                # Apply Helvetica font to the entire document
-                style = document.styles["Normal"]
-                style.font.name = "Helvetica"
-                style.font.size = Pt(11)  # Set default font size
-
-                for paragraph in steam_text.split("\n"):
-                    p = document.add_paragraph()
-                    words = paragraph.split(" ")
-                    word_count = 0
-                    for word in words:
-                        if word_count < 2 and "**" in word:
-                            run = p.add_run(word.replace("**", ""))
-                            run.bold = True
-                            run.font.size = Pt(14)  # Set bold fonts as headings
-                            word_count = word_count + 1
-                        elif "**" in word:
-                            run = p.add_run(word.replace("**", ""))
-                            run.bold = True
-                            run.font.size = Pt(13)  # Set bold fonts as sub headings
-                            word_count = word_count + 1
-                        elif "*" in word:
-                            run = p.add_run(word.replace("*", ""))
-                            run.italic = True
-                            word_count = word_count + 1
-                        else:
-                            run = p.add_run(word + " ")
-                            word_count = word_count + 1
-
-                    p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-                document.save(file_path)
-                messagebox.showinfo("Success", "STEAM ideas exported successfully.")
+                events.put(("done", work(lambda value: events.put(("progress", value)))))
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to export STEAM ideas: {e}")
+                events.put(("error", e))
+
+        def poll():
+            try:
+                while True:
+                    kind, value = events.get_nowait()
+                    if kind == "progress":
+                        if on_progress:
+                            on_progress(value)
+                    elif kind == "done":
+                        on_done(value, None)
+                        return
+                    else:
+                        on_done(None, value)
+                        return
+            except queue.Empty:
+                self.window.after(50, poll)
+
+        threading.Thread(target = worker, daemon = True).start()
+        self.window.after(50, poll)
 
     def show_about(self):
         """Displays the about message."""
@@ -282,11 +2964,142 @@ class SteamApp:
         )
 
     def show_history(self):
-        """Display the history in a message box."""
-        if self.history:
-            messagebox.showinfo("History of Last 5 Uses", "\n".join(self.history))
-        else:
-            messagebox.showinfo("History", "No History Found")
+        """Opens the history window, with search, paging and reloading of past outputs."""
+        if self.history_window is not None and self.history_window.winfo_exists():
+            self.history_window.lift()
+            return
+        store = get_history_store()
+        window = self.history_window = tk.Toplevel(self.window)
+        window.title("History")
+        window.geometry("800x450")
+        page_size = 50
+        # Ids the shown pages start after, so "Newer" can step back through them
+        page_starts = [None]
+        search_var = tk.StringVar()
+
+        search_frame = ttk.Frame(window, padding=5)
+        search_frame.pack(fill=tk.X)
+        ttk.Label(search_frame, text="Search topics and outputs:").pack(side=tk.LEFT)
+        search_entry = ttk.Entry(search_frame, textvariable=search_var, width=50)
+        search_entry.pack(side=tk.LEFT, padx=5)
+
+        columns = ("created", "topic", "age_group", "output_type", "language")
+        tree = ttk.Treeview(window, columns=columns, show="headings", selectmode="browse")
+        for column, heading, width in zip(columns, ("Date", "Topic", "Age", "Type", "Language"), (140, 330, 70, 100, 110)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5)
+
+        nav_frame = ttk.Frame(window, padding=5)
+        nav_frame.pack(fill=tk.X)
+        count_label = ttk.Label(nav_frame, text="")
+        count_label.pack(side=tk.LEFT)
+
+        def show_page():
+            tree.delete(*tree.get_children())
+            rows = store.page(search_var.get(), page_starts[-1], page_size)
+            for row in rows:
+                created = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["created"]))
+                topic = row["topic"] + (" (cut off)" if row["truncated"] else "")
+                tree.insert("", tk.END, iid=str(row["id"]),
+                            values=(created, topic, row["age_group"], row["output_type"], row["language"]))
+            total = store.count(search_var.get())
+            first = (len(page_starts) - 1) * page_size
+            count_label.config(text=f"Showing {first + 1 if rows else 0}-{first + len(rows)} of {total}")
+            newer_button.config(state=tk.NORMAL if len(page_starts) > 1 else tk.DISABLED)
+            older_button.config(state=tk.NORMAL if len(rows) == page_size and first + page_size < total else tk.DISABLED)
+
+        def search(event = None):
+            del page_starts[1:]
+            show_page()
+
+        def older():
+            children = tree.get_children()
+            if children:
+                page_starts.append(int(children[-1]))
+                show_page()
+
+        def newer():
+            if len(page_starts) > 1:
+                page_starts.pop()
+                show_page()
+
+        def reload_selected(event = None):
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("Warning", "Select an entry to load.", parent=window)
+                return
+            entry = store.get(int(selection[0]))
+            if entry:
+                self.shown_job = None
+                self.format_output_text(entry["output"], request = entry_request(entry)) # No API call needed
+
+        ttk.Button(search_frame, text="Search", command=search).pack(side=tk.LEFT)
+        search_entry.bind("<Return>", search)
+        tree.bind("<Double-1>", reload_selected)
+        ttk.Button(nav_frame, text="Load into Output", command=reload_selected).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(nav_frame, text="Export Results...", command=lambda: self.export_history(search_var.get())).pack(side=tk.RIGHT, padx=5)
+        older_button = ttk.Button(nav_frame, text="Older >", command=older)
+        older_button.pack(side=tk.RIGHT, padx=5)
+        newer_button = ttk.Button(nav_frame, text="< Newer", command=newer)
+        newer_button.pack(side=tk.RIGHT, padx=5)
+        show_page()
+
+    def show_similar(self):
+        """Lists past lessons similar to the current inputs, any of which can be loaded into the output box."""
+        index = similarity_index
+        if index is None:
+            messagebox.showinfo("Similar Past Lessons", "The history is still being indexed, please try again shortly.")
+            return
+        try:
+            time_minutes = int(self.time_entry.get() or 0) or None
+        except ValueError:
+            messagebox.showerror("Error", "Time must be a valid integer number.")
+            return
+        request = make_request(self.topic_entry.get(), self.outcomes_entry.get().split(","), self.age_entry.get(),
+                               self.output_type_var.get(), time_minutes, self.location_entry.get(), self.language_var.get())
+        matches = index.search(request, limit = 20)
+        if not matches:
+            messagebox.showinfo("Similar Past Lessons", "No similar past lessons were found for these inputs.")
+            return
+
+        window = tk.Toplevel(self.window)
+        window.title("Similar Past Lessons")
+        window.geometry("650x300")
+        columns = ("topic", "age_group", "time_minutes", "score")
+        tree = ttk.Treeview(window, columns=columns, show="headings", selectmode="browse")
+        for column, heading, width in zip(columns, ("Topic", "Age", "Minutes", "Similarity"), (360, 80, 80, 90)):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width)
+        for match in matches:
+            tree.insert("", tk.END, iid=str(match["id"]), values=(match["topic"], match["age_group"], match["time_minutes"],
+                                                                  f"{match['score']:.0%}"))
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        def load_selected(event = None):
+            selection = tree.selection()
+            if not selection:
+                messagebox.showwarning("Warning", "Select a lesson to load.", parent=window)
+                return
+            entry = get_history_store().get(int(selection[0]))
+            if entry:
+                self.shown_job = None
+                self.format_output_text(entry["output"], request = entry_request(entry)) # No API call needed
+
+        tree.bind("<Double-1>", load_selected)
+        ttk.Button(window, text="Load into Output", command=load_selected).pack(side=tk.RIGHT, padx=5, pady=5)
+
+    def show_cache_stats(self):
+        """Displays the response cache counters."""
+        stats = get_response_cache().stats()
+        messagebox.showinfo(
+            "Cache Statistics", f"Hits: {stats['hits']}\nMisses: {stats['misses']}\nStored responses: {stats['entries']}"
+        )
+
+    def clear_cache(self):
+        """Empties the response cache."""
+        if messagebox.askyesno("Clear Cache", "Remove all cached responses?"):
+            get_response_cache().clear()
 
     def change_api_key(self):
         """Allows to change the API Key"""
@@ -314,6 +3127,8 @@ class SteamApp:
             key = api_key_entry.get()
             if validate_api_key(key):
               api_key = key
+              reset_client() # Next generation builds a client for the new key
+              warm_up_client()
               messagebox.showinfo("API Key Changed", "API key changed successfully.")
               api_window.destroy()
             else:
@@ -347,7 +3162,7 @@ class SteamApp:
 
        # Output type options
         ttk.Label(self.window, text="Output Type:").grid(row=3, column=0, sticky="w", padx=10, pady=5)
-        output_options = ["Ideas", "Lesson Plan"]
+        output_options = OUTPUT_TYPES
         output_combobox = ttk.Combobox(self.window, textvariable=self.output_type_var, values = output_options, style = "TCombobox")
         output_combobox.set("Ideas") # Set the default as "Ideas"
         output_combobox.grid(row=3, column=1, padx=10, pady=5)
@@ -377,17 +3192,31 @@ class SteamApp:
         language_combobox = ttk.Combobox(
             self.window,
             textvariable=self.language_var,
-            values=["English", "Nepali"],
+            values=LANGUAGES,
             style="TCombobox",
         )
         language_combobox.set("English")
         language_combobox.grid(row=6, column=1, padx=10, pady=5)
         language_combobox.bind("<Return>", lambda event: self.generate_button.focus_set()) # When enter is pressed go to generate button
 
+        # Generation options, two per line in a frame of their own
+        ttk.Label(self.window, text="Options:").grid(row=7, column=0, sticky="w", padx=10, pady=5)
+        options_frame = ttk.Frame(self.window)
+        options_frame.grid(row=7, column=1, sticky="w", padx=10, pady=5)
+        options = [
+            ("Write lesson plan sections in parallel", self.parallel_var),
+            ("Reuse very similar past lessons", self.reuse_similar_var),
+            ("Stream output", self.stream_var),
+            ("Bypass cache (always ask Gemini)", self.bypass_cache_var),
+        ]
+        for index, (text, variable) in enumerate(options):
+            ttk.Checkbutton(options_frame, text = text, variable = variable).grid(row=index // 2, column=index % 2, sticky="w",
+                                                                                padx=(0, 20))
+
 
         # Buttons Frame
         button_frame = ttk.Frame(self.window, padding=10)
-        button_frame.grid(row=7, column=0, columnspan=2, pady=10)
+        button_frame.grid(row=8, column=0, columnspan=2, pady=10)
 
         # Generate Button
         self.generate_button = ttk.Button(
@@ -407,16 +3236,44 @@ class SteamApp:
         )
         export_button.grid(row=0, column=2, padx=5)
 
+        # Regenerate one section of the shown output
+        self.section_combobox = ttk.Combobox(button_frame, textvariable=self.section_var, values=[], state="readonly",
+                                             width=24, style="TCombobox")
+        self.section_combobox.grid(row=0, column=3, padx=5)
+        regenerate_button = ttk.Button(
+            button_frame, text="Regenerate Section", command=self.regenerate_selected_section, style="TButton"
+        )
+        regenerate_button.grid(row=0, column=4, padx=5)
+
         # Output Text Box
         self.output_text = scrolledtext.ScrolledText(
             self.window,
             wrap=tk.WORD,
             width=120,  # Increased width
-            height=20,  # Increased height
+            height=16,  # Increased height
             state=tk.NORMAL, # Changed to NORMAL to make it editable
             font=("Helvetica", 11),
         )
-        self.output_text.grid(row=8, column=0, columnspan=2, padx=10, pady=10)
+        self.output_text.grid(row=9, column=0, columnspan=2, padx=10, pady=10)
+
+        # Generation jobs, newest first
+        job_frame = ttk.Frame(self.window)
+        job_frame.grid(row=10, column=0, columnspan=2, sticky="ew", padx=10)
+        job_frame.columnconfigure(0, weight=1)
+        self.job_list = ttk.Treeview(job_frame, columns=("job", "status", "progress"), show="headings", height=4)
+        self.job_list.heading("job", text="Job")
+        self.job_list.heading("status", text="Status")
+        self.job_list.heading("progress", text="Progress")
+        self.job_list.column("job", width=420)
+        self.job_list.column("status", width=90)
+        self.job_list.column("progress", width=320)
+        self.job_list.grid(row=0, column=0, sticky="ew")
+        self.job_list.bind("<<TreeviewSelect>>", self.select_job)
+        ttk.Button(job_frame, text="Cancel Job", command=self.cancel_selected_job).grid(row=0, column=1, padx=5)
+
+        # Status line for background work
+        self.status_label = ttk.Label(self.window, text="")
+        self.status_label.grid(row=11, column=0, columnspan=2, sticky="w", padx=10)
 
 
         # Menu Bar
@@ -429,13 +3286,30 @@ class SteamApp:
 
         history_menu = tk.Menu(menu_bar, tearoff = 0)
         history_menu.add_command(label="History", command=self.show_history)
+        history_menu.add_command(label="Similar Past Lessons", command=self.show_similar)
         menu_bar.add_cascade(label="History", menu = history_menu)
 
+        cache_menu = tk.Menu(menu_bar, tearoff = 0)
+        cache_menu.add_command(label="Cache Statistics", command=self.show_cache_stats)
+        cache_menu.add_command(label="Clear Cache", command=self.clear_cache)
+        menu_bar.add_cascade(label="Cache", menu = cache_menu)
+
+        export_menu = tk.Menu(menu_bar, tearoff = 0)
+        export_menu.add_command(label="Export History...", command=self.export_history)
+        export_menu.add_command(label="Export Batch Results...", command=self.export_batch_results)
+        menu_bar.add_cascade(label="Export", menu = export_menu)
+
         about_menu = tk.Menu(menu_bar, tearoff=0)
         about_menu.add_command(label="About", command=self.show_about)
         menu_bar.add_cascade(label="About", menu=about_menu)
 
+    def close(self):
+        """Cancels running jobs and closes the window."""
+        self.jobs.shutdown()
+        self.window.destroy()
+
     def run(self):
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
         self.window.mainloop()
 
 
@@ -468,6 +3342,7 @@ def api_key_window():
         key = api_key_entry.get()
         if validate_api_key(key):
             api_key = key
+            warm_up_client() # Import and configure Gemini while the main window opens
             api_window.destroy()  # Close the API window
             app = SteamApp()  # Start the main application
             app.run()
@@ -478,5 +3353,63 @@ def api_key_window():
     submit_button.pack(pady=10)
     api_window.mainloop()
 
+def main(argv = None):
+    """Starts the GUI, or runs a headless batch when --batch is given."""
+    global api_key, request_scheduler
+    parser = argparse.ArgumentParser(description="STEAM Integration Generator")
+    parser.add_argument("--batch", metavar="FILE", help="CSV or JSONL file of lessons to generate without the GUI")
+    parser.add_argument("--output", default="steam_results.jsonl", help="JSON lines file the batch results are written to")
+    parser.add_argument("--workers", type=int, default=4, help="Number of generations running at the same time")
+    parser.add_argument("--max-pending", type=int, help="Rows read ahead of the finished ones (default: twice the workers)")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="Gemini API key (default: $GEMINI_API_KEY)")
+    parser.add_argument("--backend", default=os.environ.get("STEAM_BACKEND", "gemini"),
+                        help="Model backend: gemini, stub or fake, with options like fake:latency=0.5,failure_rate=0.1 (default: $STEAM_BACKEND or gemini)")
+    parser.add_argument("--stub", action="store_true", help="Use a local stub model instead of Gemini (same as --backend stub)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache and always call the model")
+    parser.add_argument("--cache-path", default=CACHE_PATH, help="SQLite file used for the response cache")
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE, help="Requests per minute allowed (0 for no limit)")
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE, help="Estimated prompt tokens per minute allowed (0 for no limit)")
+    parser.add_argument("--metrics-log", default=METRICS_LOG, help="Write per-stage timings and counters to this JSON lines file")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus-style metrics on this local port")
+    args = parser.parse_args(argv)
+    if args.metrics_log or args.metrics_port:
+        instrumentation.configure(args.metrics_log, args.metrics_port)
+    try:
+        use_backend(make_backend("stub" if args.stub else args.backend))
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not args.batch:
+        if model_backend is None:
+            api_key_window()
+        else:
+            SteamApp().run() # Local backends need no API key
+        return 0
+
+    model = None
+    if model_backend is None:
+        if validate_api_key(args.api_key):
+            api_key = args.api_key
+        else:
+            parser.error("a valid Gemini API key is required, pass --api-key or set GEMINI_API_KEY")
+
+    def report(done, failed, result):
+        status = "failed" if result["error"] else "done"
+        title = result.get("topic") or f"row {result['index']}" # Unreadable rows have no topic
+        print(f"[{done}] {title}: {status} in {result.get('elapsed', 0)}s", file=sys.stderr)
+
+    request_scheduler = RequestScheduler(args.rpm, args.tpm)
+    cache = None if args.no_cache else ResponseCache(args.cache_path)
+    counts = run_batch(args.batch, args.output, workers = max(1, args.workers), max_pending = args.max_pending,
+                       model = model, cache = cache, progress = report)
+    print(f"Generated {counts['done'] - counts['failed']} of {counts['done']} rows into {args.output}")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    metrics = request_scheduler.metrics()
+    print(f"Requests: {metrics['completed']} completed, {metrics['failed']} failed, {metrics['retries']} retries, "
+          f"throttled {metrics['throttled']} times for {metrics['throttle_seconds']}s")
+    return 1 if counts["failed"] else 0
+
 if __name__ == "__main__":
-  api_key_window()
+  sys.exit(main())
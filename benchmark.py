@@ -0,0 +1,747 @@
+"""Performance benchmarks for the STEAM Integration Generator.
+
+Run every benchmark with `python benchmark.py`, or pick some by name, e.g. `python benchmark.py connections`.
+Results are printed as JSON. Save a run with `--output baseline.json`, then check a later run against it with
+`--compare baseline.json`, which exits with status 1 if any timing got slower than the tolerance allows.
+"""
+import argparse
+import asyncio
+import http.client
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import STEAM
+import server as steam_server
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers Gemini REST generateContent calls with a fixed response, keeping connections alive."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # Headers and body are written separately
+    response_text = "**Stand-in Output**\n*Served by the local benchmark server.*"
+    # Share of requests answered with 429, and of requests delayed by spike_seconds
+    failure_rate = 0.0
+    spike_rate = 0.0
+    spike_seconds = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if random.random() < self.spike_rate:
+            time.sleep(self.spike_seconds)
+        if random.random() < self.failure_rate:
+            body = json.dumps({"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota)."}})
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+            return
+        response = {
+            "candidates": [{
+                "content": {"parts": [{"text": self.response_text}], "role": "model"},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+        }
+        if ":streamGenerateContent" in self.path:
+            response = [response] # REST streaming returns a JSON array of responses
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep benchmark output clean
+
+
+class FakeTranslator:
+    """Stand-in for googletrans with a fixed per-request latency plus a per-character cost."""
+    def __init__(self, latency = 0.05, seconds_per_char = 0.00002):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def translate(self, text, dest):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency + len(text) * self.seconds_per_char)
+        return STEAM.StubResponse("\n".join("[%s] %s" % (dest, line) for line in text.split("\n")))
+
+
+def synthetic_output(sections = 10, paragraphs = 4):
+    """Builds a lesson-plan-like markdown document of roughly predictable size."""
+    headings = ["Engage", "Explore", "Explain", "Elaborate", "Evaluate", "Materials Needed", "STEAM Integration"]
+    lines = ["**Title of the Lesson: Photosynthesis in Plants**", ""]
+    for section in range(sections):
+        lines.append("**%s**" % headings[section % len(headings)])
+        for paragraph in range(paragraphs):
+            lines.append("*   **Activity %d:** Students observe *leaf sample %d* under a hand lens, record what they see "
+                         "in table %d and compare notes with a partner before sharing with the class." % (paragraph + 1, section, section * paragraphs + paragraph))
+        lines.append("")
+    return "\n".join(lines)
+
+
+class LengthModel:
+    """Stub model whose response time grows with the length of what it writes, like a real model's.
+
+    A full lesson plan is as long as all of its sections together, an outline is a fraction of one section.
+    """
+    def __init__(self, latency = 0.1, seconds_per_word = 0.0005, section_words = 250, outline_words = 100):
+        self.latency = latency
+        self.seconds_per_word = seconds_per_word
+        self.section_words = section_words
+        self.outline_words = outline_words
+
+    def generate_content(self, prompt, stream = False, generation_config = None):
+        if "Sketch a brief outline" in prompt:
+            words = self.outline_words
+        elif "Write only this section" in prompt:
+            words = self.section_words
+        else:
+            words = self.section_words * len(STEAM.LESSON_SECTIONS)
+        chunks = self.write(words)
+        return chunks if stream else STEAM.StubResponse("".join(chunk.text for chunk in chunks))
+
+    def write(self, words, chunk_words = 50):
+        time.sleep(self.latency) # Time to first token
+        for written in range(0, words, chunk_words):
+            count = min(chunk_words, words - written)
+            time.sleep(count * self.seconds_per_word)
+            yield STEAM.StubResponse("word " * count)
+
+
+class StandInModel:
+    """Minimal Gemini REST client for the stand-in server, keeping one connection per thread."""
+    def __init__(self, server):
+        self.host, self.port = server.server_address
+        self.local = threading.local()
+
+    def generate_content(self, prompt, stream = False, generation_config = None):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port)
+        request = {"contents": [{"parts": [{"text": prompt}]}]}
+        if generation_config:
+            request["generationConfig"] = {"maxOutputTokens": generation_config["max_output_tokens"]}
+        body = json.dumps(request)
+        connection.request("POST", "/v1beta/models/gemini-pro:generateContent", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise STEAM.BackendError(response.status, data["error"]["message"])
+        return STEAM.StubResponse(data["candidates"][0]["content"]["parts"][0]["text"])
+
+
+def start_stand_in(**behaviour):
+    """Starts the stand-in server on a free local port and returns it.
+
+    Keyword arguments override StandInHandler settings such as failure_rate, spike_rate and spike_seconds.
+    """
+    handler = type("ConfiguredStandInHandler", (StandInHandler,), behaviour)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def summarize(durations):
+    """Returns the mean and percentiles of a list of durations in milliseconds."""
+    ordered = sorted(durations)
+    return {
+        "requests": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "p50_ms": round(ordered[len(ordered) // 2], 3),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+    }
+
+
+@contextmanager
+def use_scheduler(requests_per_minute = 0, **options):
+    """Makes generations go through a new RequestScheduler (by default without a rate limit) until the block ends."""
+    previous = STEAM.request_scheduler
+    STEAM.request_scheduler = scheduler = STEAM.RequestScheduler(requests_per_minute = requests_per_minute, **options)
+    try:
+        yield scheduler
+    finally:
+        STEAM.request_scheduler = previous
+
+
+def time_calls(function, count):
+    """Calls a function count times and returns each duration in milliseconds."""
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+# Time allowed from launch until the API key window is on screen (or until STEAM is imported, without a display)
+STARTUP_BUDGET_MS = float(os.environ.get("STEAM_STARTUP_BUDGET_MS", "1500"))
+# Modules that should only be imported when first used, not at startup
+LAZY_MODULES = ("google.generativeai", "googletrans", "docx")
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import tkinter
+import STEAM
+result = {"import_ms": (time.perf_counter() - started) * 1000,
+          "eager_modules": [name for name in %r if name in sys.modules]}
+def shown(window):
+    window.update() # Draw the window once, then close it instead of waiting for input
+    result["key_window_ms"] = (time.perf_counter() - started) * 1000
+    window.destroy()
+tkinter.Tk.mainloop = shown
+try:
+    STEAM.api_key_window()
+except tkinter.TclError:
+    pass # No display
+print(json.dumps(result))
+""" % (LAZY_MODULES,)
+
+
+def bench_startup(runs = 5, budget_ms = None):
+    """Cold start in a fresh interpreter: importing STEAM, and launching until the API key window is drawn.
+
+    Fails the run (over_budget) if the median launch takes longer than the startup budget.
+    """
+    budget_ms = STARTUP_BUDGET_MS if budget_ms is None else budget_ms
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs_seen = []
+    for _ in range(runs):
+        finished = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd = here, capture_output = True, text = True)
+        if finished.returncode:
+            return {"error": finished.stderr.strip().splitlines()[-1]}
+        runs_seen.append(json.loads(finished.stdout.strip().splitlines()[-1]))
+    import_ms = sorted(run["import_ms"] for run in runs_seen)[len(runs_seen) // 2]
+    results = {"import_ms": round(import_ms, 3), "eager_modules": runs_seen[0]["eager_modules"], "budget_ms": budget_ms}
+    if "key_window_ms" in runs_seen[0]:
+        results["key_window_ms"] = round(sorted(run["key_window_ms"] for run in runs_seen)[len(runs_seen) // 2], 3)
+    else:
+        results["tk"] = "skipped, no display"
+    results["over_budget"] = results.get("key_window_ms", import_ms) > budget_ms or bool(results["eager_modules"])
+    return results
+
+
+def bench_prompt(count = 2000, rounds = 5):
+    """Building prompts for each kind of output, timed in batches since one prompt takes microseconds, and their size."""
+    results = {}
+    for output_type in ("Ideas", "Lesson Plan"):
+        def build_batch():
+            for _ in range(count):
+                STEAM.generate_prompt("Photosynthesis", ["Explain the process", "Measure growth"], "10", output_type, 40, "Kathmandu")
+        durations = time_calls(build_batch, rounds)
+        results[output_type.lower().replace(" ", "_")] = {"prompts": count, "best_batch_ms": round(min(durations), 3),
+                                                          "per_prompt_us": round(min(durations) * 1000 / count, 3)}
+        for template in ("full", "compact"):
+            budget = STEAM.budget_prompt("Photosynthesis", ["Explain the process", "Measure growth"], "10", output_type, 40,
+                                         "Kathmandu", template = template)
+            results[output_type.lower().replace(" ", "_")][template + "_tokens"] = budget["estimated_prompt_tokens"]
+    return results
+
+
+def bench_model(requests = 40, workers = 4):
+    """Generation round-trips through the fake backend, with a tenth of calls failing and being retried.
+
+    The backend is seeded, so every run sees the same failures and writes the same text.
+    """
+    model = STEAM.FakeBackend(latency = 0.02, seconds_per_word = 0.00002, words = 600, failure_rate = 0.1, seed = 1)
+
+    def generate(index):
+        started = time.perf_counter()
+        text = STEAM.generate_output("Topic %d" % index, ["Explain"], "10", "Ideas", 40, model = model)
+        return (time.perf_counter() - started) * 1000, not text.startswith("Error")
+
+    started = time.perf_counter()
+    with use_scheduler(max_retries = 6, base_delay = 0.01, max_delay = 0.1) as scheduler:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            outcomes = list(pool.map(generate, range(requests)))
+    results = summarize([duration for duration, _ in outcomes])
+    results["succeeded"] = sum(1 for _, succeeded in outcomes if succeeded)
+    results["model_calls"] = model.calls
+    results["seconds"] = round(time.perf_counter() - started, 3)
+    results["retries"] = scheduler.metrics()["retries"]
+    return results
+
+
+def bench_connections(requests = 300):
+    """Per-request cost of opening a new connection versus reusing one kept-alive connection."""
+    server = start_stand_in()
+    host, port = server.server_address
+    body = json.dumps({"contents": [{"parts": [{"text": "benchmark"}]}]})
+    path = "/v1beta/models/gemini-pro:generateContent"
+
+    def fresh_request():
+        connection = http.client.HTTPConnection(host, port)
+        connection.request("POST", path, body, {"Content-Type": "application/json"})
+        connection.getresponse().read()
+        connection.close()
+
+    pooled = http.client.HTTPConnection(host, port)
+    def pooled_request():
+        pooled.request("POST", path, body, {"Content-Type": "application/json"})
+        pooled.getresponse().read()
+
+    try:
+        return {"fresh": summarize(time_calls(fresh_request, requests)),
+                "pooled": summarize(time_calls(pooled_request, requests))}
+    finally:
+        pooled.close()
+        server.shutdown()
+
+
+def bench_client(requests = 100):
+    """Per-generation overhead of building a new Gemini client every time versus the shared ModelClient."""
+    server = start_stand_in()
+    endpoint = "http://%s:%d" % server.server_address
+    key = "AIzaSy" + "0" * 33
+    prompt = STEAM.generate_prompt("Photosynthesis", ["Explain the process"], "10", "Ideas", 40)
+
+    def fresh_generation():
+        client = STEAM.ModelClient(key, endpoint) # What every generation used to pay
+        client.model.generate_content(prompt)
+
+    STEAM.api_key, STEAM.api_endpoint = key, endpoint
+    STEAM.reset_client()
+    def shared_generation():
+        STEAM.create_model().generate_content(prompt)
+
+    try:
+        return {"fresh": summarize(time_calls(fresh_generation, requests)),
+                "shared": summarize(time_calls(shared_generation, requests))}
+    finally:
+        STEAM.reset_client()
+        server.shutdown()
+
+
+def bench_translation(sections = 20):
+    """Whole-document translation versus the chunked, memoized pipeline, and direct generation in Nepali."""
+    document = synthetic_output(sections)
+    results = {"characters": len(document)}
+
+    translator = FakeTranslator()
+    started = time.perf_counter()
+    translator.translate(document, "ne")
+    results["whole_document"] = {"seconds": round(time.perf_counter() - started, 3), "requests": translator.requests}
+
+    STEAM.translation_memo.clear()
+    for run in ("pipeline_cold", "pipeline_warm"):
+        translator = FakeTranslator()
+        started = time.perf_counter()
+        STEAM.translate_document(document, "ne", translator = translator)
+        results[run] = {"seconds": round(time.perf_counter() - started, 3), "requests": translator.requests}
+
+    model = STEAM.StubModel()
+    started = time.perf_counter()
+    STEAM.generate_output("Photosynthesis", ["Explain the process"], "10", "Ideas", 40, language = "Nepali (direct)", model = model)
+    results["direct_generation"] = {"seconds": round(time.perf_counter() - started, 3), "requests": 1}
+    return results
+
+
+def legacy_render(widget, text):
+    """The word-by-word rendering loop the app used before parse_markdown, returning the number of inserts."""
+    inserts = 0
+    for paragraph in text.split("\n"):
+        word_count = 0
+        for word in paragraph.split(" "):
+            if word_count < 2 and "**" in word:
+                widget.insert(tk.END, word.replace("**", ""), "heading")
+            elif "**" in word:
+                widget.insert(tk.END, word.replace("**", ""), "subheading")
+            elif "*" in word:
+                widget.insert(tk.END, word.replace("*", ""), "italic")
+            else:
+                widget.insert(tk.END, word + " ")
+            word_count += 1
+            inserts += 1
+        widget.insert(tk.END, "\n")
+        inserts += 1
+    return inserts
+
+
+def bench_render(sections = 200):
+    """Parsing and rendering a large output: legacy per-word inserts versus one insert per parsed span."""
+    document = synthetic_output(sections)
+    started = time.perf_counter()
+    spans = STEAM.parse_markdown(document)
+    results = {
+        "characters": len(document),
+        "parse_seconds": round(time.perf_counter() - started, 4),
+        "spans": len(spans),
+        "docx_runs": sum(len(line) for line in STEAM.split_span_lines(spans)),
+        "legacy_docx_runs": sum(len(line.split(" ")) for line in document.split("\n")),
+    }
+
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        results["tk"] = "skipped, no display"
+    else:
+        root.withdraw()
+        widget = tk.Text(root)
+        started = time.perf_counter()
+        results["legacy_inserts"] = legacy_render(widget, document)
+        results["legacy_render_seconds"] = round(time.perf_counter() - started, 4)
+        widget.delete("1.0", tk.END)
+        started = time.perf_counter()
+        arguments = []
+        for text, style in STEAM.parse_markdown(document):
+            arguments.extend((text, style or ()))
+        widget.insert(tk.END, *arguments)
+        results["span_render_seconds"] = round(time.perf_counter() - started, 4)
+        # The app's own rendering path, on a bare output box instead of the whole window
+        app = STEAM.SteamApp.__new__(STEAM.SteamApp)
+        app.output_text = widget
+        app.section_combobox = None # No section picker to fill in
+        started = time.perf_counter()
+        app.format_output_text(document)
+        results["format_output_text_seconds"] = round(time.perf_counter() - started, 4)
+        root.destroy()
+
+    started = time.perf_counter()
+    STEAM.add_spans_to_document(STEAM.new_document(), spans)
+    results["docx_seconds"] = round(time.perf_counter() - started, 4)
+    return results
+
+
+def bench_export(sections = 50, lessons = 20):
+    """Saving one output as DOCX, and many lessons into one combined DOCX."""
+    document = synthetic_output(sections)
+    results = {"characters": len(document)}
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    STEAM.write_docx(document, buffer)
+    results["docx_seconds"] = round(time.perf_counter() - started, 4)
+    results["docx_bytes"] = buffer.tell()
+
+    lesson = synthetic_output(10)
+    started = time.perf_counter()
+    STEAM.export_combined_docx((("Lesson %d" % index, lesson) for index in range(lessons)), io.BytesIO())
+    results["combined_docx_seconds"] = round(time.perf_counter() - started, 4)
+    results["lessons"] = lessons
+    return results
+
+
+def bench_scheduler(requests = 200, workers = 16):
+    """Generations through the request scheduler against a stand-in that returns 429s and latency spikes."""
+    server = start_stand_in(failure_rate = 0.2, spike_rate = 0.05, spike_seconds = 0.3)
+    model = StandInModel(server)
+
+    def generate(index):
+        started = time.perf_counter()
+        text = STEAM.generate_output("Topic %d" % index, ["Explain"], "10", "Ideas", 40, model = model,
+                                     deadline = time.monotonic() + 10)
+        return (time.perf_counter() - started) * 1000, not text.startswith("Error")
+
+    started = time.perf_counter()
+    try:
+        with use_scheduler(6000, max_retries = 6, base_delay = 0.02, max_delay = 0.5, burst = 20) as scheduler:
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                outcomes = list(pool.map(generate, range(requests)))
+    finally:
+        server.shutdown()
+    results = summarize([duration for duration, _ in outcomes])
+    results["succeeded"] = sum(1 for _, succeeded in outcomes if succeeded)
+    results["seconds"] = round(time.perf_counter() - started, 3)
+    results["scheduler"] = scheduler.metrics()
+    return results
+
+
+def bench_server(requests = 400, clients = 32, delay = 0.05):
+    """Load test of the HTTP service: concurrent clients on keep-alive connections, each with its own client id."""
+    # Every client connects from 127.0.0.1, so the limit has to go by client id
+    service = steam_server.SteamServer(STEAM.StubModel(delay), workers = 16, per_client = 1, max_pending = clients,
+                                       trust_client_id = True)
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(service.start("127.0.0.1", 0))
+    port = listener.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    statuses = {}
+    lock = threading.Lock()
+
+    def client(index):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        durations = []
+        # A topic per client, so identical requests are not coalesced into one
+        body = json.dumps({"topic": "Plants %d" % index, "outcomes": "Explain growth", "age_group": "10", "time_minutes": 40})
+        for _ in range(requests // clients):
+            started = time.perf_counter()
+            connection.request("POST", "/api/generate", body, {"X-Client-Id": str(index)})
+            response = connection.getresponse()
+            response.read()
+            durations.append((time.perf_counter() - started) * 1000)
+            with lock:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        connection.close()
+        return durations
+
+    started = time.perf_counter()
+    try:
+        with use_scheduler(): # Measure the service, not the rate limit
+            with ThreadPoolExecutor(max_workers = clients) as pool:
+                durations = [duration for batch in pool.map(client, range(clients)) for duration in batch]
+    finally:
+        loop.call_soon_threadsafe(listener.close)
+        loop.call_soon_threadsafe(loop.stop)
+        service.executor.shutdown()
+    seconds = time.perf_counter() - started
+    results = summarize(durations)
+    results["requests_per_second"] = round(len(durations) / seconds, 1)
+    results["statuses"] = statuses
+    return results
+
+
+def bench_coalescing(requests = 50, delay = 0.2):
+    """Identical generations started together, which should share a single model call."""
+    calls = []
+
+    class CountingModel(STEAM.StubModel):
+        def generate_content(self, prompt, stream = False, generation_config = None):
+            calls.append(prompt)
+            return super().generate_content(prompt, stream, generation_config)
+
+    model = CountingModel(delay)
+    barrier = threading.Barrier(requests)
+
+    def generate(index):
+        barrier.wait()
+        started = time.perf_counter()
+        STEAM.generate_output("Photosynthesis", ["Explain"], "10", "Ideas", 40, model = model)
+        return (time.perf_counter() - started) * 1000
+
+    with use_scheduler(), ThreadPoolExecutor(max_workers = requests) as pool:
+        durations = list(pool.map(generate, range(requests)))
+    results = summarize(durations)
+    results["model_calls"] = len(calls)
+    return results
+
+
+def bench_sections(runs = 5):
+    """End-to-end lesson plan latency, one long completion versus an outline and parallel sections."""
+    model = LengthModel()
+    results = {}
+    with use_scheduler():
+        for name, parallel_sections in (("single_prompt", False), ("parallel_sections", True)):
+            durations = []
+            first_text = []
+            for run in range(runs):
+                details = {}
+                started = time.perf_counter()
+                for _ in STEAM.stream_output("Topic %d" % run, ["Explain"], "10", "Lesson Plan", 40, model = model,
+                                             details = details, parallel_sections = parallel_sections):
+                    pass
+                durations.append((time.perf_counter() - started) * 1000)
+                first_text.append(details["first_chunk"] * 1000)
+            results[name] = summarize(durations)
+            results[name]["first_text_ms"] = round(sum(first_text) / len(first_text), 3)
+    return results
+
+
+def bench_regenerate(runs = 3):
+    """Regenerating one section of a lesson plan versus the whole plan, and re-exporting it incrementally."""
+    model = STEAM.FakeBackend(latency = 0.05, seconds_per_word = 0.0002, words = 2000)
+    request = STEAM.make_request("Photosynthesis", ["Explain the process"], "10", "Lesson Plan", 40, "Kathmandu")
+    results = {}
+    with use_scheduler():
+        whole, section = [], []
+        for run in range(runs):
+            details = {}
+            started = time.perf_counter()
+            text = STEAM.generate_output("Photosynthesis %d" % run, request["outcomes"], "10", "Lesson Plan", 40, "Kathmandu",
+                                         model = model, details = details)
+            whole.append((time.perf_counter() - started) * 1000)
+            document = STEAM.LessonDocument(text)
+            section_details = {}
+            started = time.perf_counter()
+            new_text = STEAM.regenerate_section(request, document, document.find("Evaluate"), model = model,
+                                                details = section_details)
+            section.append((time.perf_counter() - started) * 1000)
+        results["whole_plan"] = summarize(whole)
+        results["whole_plan"].update(STEAM.token_counts(details))
+        results["one_section"] = summarize(section)
+        results["one_section"].update(STEAM.token_counts(section_details))
+
+    export = STEAM.SectionedDocx()
+    started = time.perf_counter()
+    export.update(document)
+    results["docx_full_seconds"] = round(time.perf_counter() - started, 4)
+    document.replace(document.find("Evaluate"), new_text)
+    started = time.perf_counter()
+    results["docx_sections_rebuilt"] = export.update(document)
+    results["docx_incremental_seconds"] = round(time.perf_counter() - started, 4)
+    results["sections"] = len(document.sections)
+    return results
+
+
+def bench_jobs(jobs = 8, words = 2000):
+    """Main loop time spent per poll while several long streaming jobs report through the job manager."""
+    model = LengthModel(latency = 0.05, seconds_per_word = 0.0002, section_words = words)
+    manager = STEAM.JobManager(max_workers = jobs)
+
+    def work(job, emit):
+        for chunk in STEAM.stream_output(job.title, ["Explain"], "10", "Ideas", 40, model = model,
+                                         cancel_event = job.cancel_event):
+            emit("chunk", chunk)
+        return job.output or "done"
+
+    durations = []
+    events = 0
+    started = time.perf_counter()
+    try:
+        with use_scheduler():
+            for index in range(jobs):
+                manager.submit("Topic %d" % index, work)
+            while manager.active():
+                poll_started = time.perf_counter()
+                events += len(manager.poll())
+                durations.append((time.perf_counter() - poll_started) * 1000)
+                time.sleep(0.016) # One frame
+    finally:
+        manager.shutdown()
+    results = summarize(durations)
+    results["max_ms"] = round(max(durations), 3)
+    results["events"] = events
+    results["seconds"] = round(time.perf_counter() - started, 3)
+    return results
+
+
+SUBJECTS = ["photosynthesis", "volcanoes", "fractions", "water cycle", "magnets", "simple machines", "the solar system",
+            "ecosystems", "weather", "electric circuits", "sound waves", "plant growth", "human body", "recycling",
+            "geometry", "states of matter", "erosion", "food chains", "light and shadows", "bridges"]
+ANGLES = ["in plants", "at home", "with pizza", "for beginners", "outdoors", "through art", "in our town", "and energy",
+          "with robots", "in history", "and music", "in sport", "under the sea", "in space", "with games"]
+OUTCOMES = ["Understand the process", "Identify key components", "Measure and record data", "Build a model",
+            "Explain causes and effects", "Compare and contrast", "Design an experiment", "Present findings"]
+
+
+def synthetic_request(index, rng):
+    """A plausible request, varied enough that most of a large history is not a near-duplicate of it."""
+    topic = "%s %s %d" % (rng.choice(SUBJECTS), rng.choice(ANGLES), index % 500)
+    age = rng.randint(6, 16)
+    age_group = str(age) if rng.random() < 0.5 else "%d-%d" % (age, age + 1)
+    return STEAM.make_request(topic, rng.sample(OUTCOMES, 2), age_group, rng.choice(STEAM.OUTPUT_TYPES),
+                              rng.choice([30, 40, 45, 60]), "", "English")
+
+
+def bench_similarity(entries = 100000, queries = 200):
+    """Building the near-duplicate index from a large history, and looking up requests in it."""
+    rng = random.Random(1)
+    store = STEAM.HistoryStore(":memory:")
+    for index in range(entries):
+        store.add(synthetic_request(index, rng), "Output %d" % index)
+    started = time.perf_counter()
+    index = STEAM.SimilarityIndex().load(store)
+    build_seconds = time.perf_counter() - started
+    requests = [synthetic_request(rng.randrange(entries), rng) for _ in range(queries)]
+    found = []
+    durations = time_calls(lambda: found.append(len(index.search(requests[len(found)]))), queries)
+    store.close()
+    results = summarize(durations)
+    results["entries"] = len(index)
+    results["build_seconds"] = round(build_seconds, 3)
+    results["queries_with_matches"] = sum(1 for count in found if count)
+    return results
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "prompt": bench_prompt,
+    "model": bench_model,
+    "connections": bench_connections,
+    "client": bench_client,
+    "translation": bench_translation,
+    "render": bench_render,
+    "export": bench_export,
+    "scheduler": bench_scheduler,
+    "server": bench_server,
+    "coalescing": bench_coalescing,
+    "sections": bench_sections,
+    "regenerate": bench_regenerate,
+    "jobs": bench_jobs,
+    "similarity": bench_similarity,
+}
+
+
+def timings(results, prefix = ""):
+    """Yields (path, value) for every timing in nested results, where lower is better."""
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            yield from timings(value, path + ".")
+        elif isinstance(value, (int, float)) and (key.endswith("_ms") or key == "seconds" or key.endswith("_seconds")):
+            yield path, value
+
+
+def compare(results, baseline, tolerance):
+    """Returns a line per timing found in both runs, and the paths that got slower than the tolerance allows.
+
+    Timings under a millisecond in the baseline are too noisy to judge and are left out.
+    """
+    previous = dict(timings(baseline))
+    lines = []
+    regressions = []
+    for path, value in timings(results):
+        if path not in previous or previous[path] * (1 if path.endswith("_ms") else 1000) < 1:
+            continue
+        ratio = value / previous[path]
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(path)
+        lines.append("%-50s %10.4g %10.4g %6.2fx%s" % (path, previous[path], value, ratio, "  SLOWER" if regressed else ""))
+    return lines, regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="STEAM Integration Generator benchmarks")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run: %s (default: all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--output", metavar="FILE", help="Also save the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare the timings with a saved run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown allowed before --compare fails (default: 0.2 for 20%%)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark: %s" % ", ".join(unknown))
+    results = {}
+    for name in args.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=2))
+    status = 0
+    startup = results.get("startup", {})
+    if startup.get("over_budget"):
+        if startup["eager_modules"]:
+            print("Startup imports %s, which should load on first use" % ", ".join(startup["eager_modules"]), file=sys.stderr)
+        else:
+            print("Startup took longer than its %s ms budget" % startup["budget_ms"], file=sys.stderr)
+        status = 1
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("%-50s %10s %10s %7s" % ("timing", "baseline", "now", "ratio"), file=sys.stderr)
+        for line in lines:
+            print(line, file=sys.stderr)
+        if regressions:
+            print("%d timings slower than the baseline: %s" % (len(regressions), ", ".join(regressions)), file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@ document.addEventListener('DOMContentLoaded', () => {
  document.getElementById('about-button').addEventListener('click', showAbout);
  document.getElementById('change-api-button').addEventListener('click', changeAPIKey);
  document.getElementById('api-key').addEventListener('input', hideApiKeyError); // Add listener to clear API key error on input
+ detectServer(); // Page served by server.py? Then use it for generation
 
  // --- Dark/Light Mode Toggle ---
  const toggleModeButton = document.getElementById('toggle-mode-button');
@@ -38,9 +39,60 @@ function hideApiKeyError() {
 }
 
 
+// --- Local Server (server.py) ---
+const clientId = Math.random().toString(36).slice(2); // Lets a server started with --trust-client-id limit requests per browser tab
+
+// Fills in the server URL only when this page's own origin answers like server.py, so static hosting keeps using the API key
+async function detectServer() {
+ if (!location.protocol.startsWith('http')) return;
+ try {
+ const response = await fetch(location.origin + '/api/health');
+ const data = response.ok ? await response.json() : null;
+ const serverUrlInput = document.getElementById('server-url');
+ if (data && data.status === 'ok' && 'scheduler' in data && !serverUrlInput.value.trim()) {
+ serverUrlInput.value = location.origin;
+ }
+ } catch (error) {
+ // No server.py here (or not JSON), leave the field empty
+ }
+}
+
+function getServerUrl() {
+ return document.getElementById('server-url').value.trim().replace(/\/+$/, '');
+}
+
+async function callServer(serverUrl, request, onText) {
+ // Streams the output from the server, calling onText with the text received so far
+ try {
+ const response = await fetch(serverUrl + '/api/generate', {
+ method: 'POST',
+ headers: { 'Content-Type': 'application/json', 'X-Client-Id': clientId },
+ body: JSON.stringify({ ...request, stream: true })
+ });
+ if (!response.ok) {
+ const errorData = await response.json();
+ throw new Error(`HTTP error! status: ${response.status}, message: ${errorData.error}`);
+ }
+ const reader = response.body.getReader();
+ const decoder = new TextDecoder();
+ let text = '';
+ while (true) {
+ const { done, value } = await reader.read();
+ if (done) break;
+ text += decoder.decode(value, { stream: true });
+ onText(text);
+ }
+ return text;
+ } catch (error) {
+ console.error('Error calling server:', error);
+ return `Error generating STEAM ideas: ${error.message}`;
+ }
+}
+
 async function generateSTEAM() {
+ const serverUrl = getServerUrl();
  const apiKey = document.getElementById('api-key').value.trim();
- if (!apiKey) {
+ if (!apiKey && !serverUrl) {
  displayApiKeyError(); // Use dedicated function for API key error
  return;
  }
@@ -79,32 +131,42 @@ async function generateSTEAM() {
  document.getElementById('output-text').textContent = ''; // Clear previous output
 
 
- const prompt = generatePrompt(topic, outcomes, ageGroup, outputType, timeMinutes, locationName);
  let generatedText = "";
+ if (serverUrl) {
+ const request = { topic: topic, outcomes: outcomes, age_group: ageGroup, output_type: outputType, time_minutes: timeMinutes, location_name: locationName };
+ generatedText = await callServer(serverUrl, request, text => {
+ document.getElementById('loading-overlay').style.display = 'none'; // Show the output as it arrives
+ document.getElementById('output-text').innerHTML = renderMarkdown(text);
+ });
+ } else {
+ const prompt = generatePrompt(topic, outcomes, ageGroup, outputType, timeMinutes, locationName);
  try {
  generatedText = await callGeminiAPI(apiKey, prompt);
  } catch (apiError) {
  console.error("API Call Failed:", apiError);
  generatedText = `Error generating STEAM ideas. Please check the console for details.`; // User-friendly error
  }
+ }
 
 
  // No translation needed anymore - always English
 
- // --- Markdown to HTML Conversion ---
- let formattedText = generatedText;
+ document.getElementById('output-text').innerHTML = renderMarkdown(generatedText); // Set formatted HTML output
+ document.getElementById('generate-button').textContent = 'Generate';
+ document.getElementById('generate-button').disabled = false;
+ document.getElementById('loading-overlay').style.display = 'none'; // Hide loading overlay
+}
+
+// --- Markdown to HTML Conversion ---
+function renderMarkdown(text) {
+ let formattedText = text;
  formattedText = formattedText.replace(/\*\*(.*?)\*\*/g, '<b>$1</b>'); // Bold
  formattedText = formattedText.replace(/\*(.*?)\*/g, '<i>$1</i>'); // Italic
  formattedText = formattedText.replace(/```([\s\S]*?)```/g, '<pre><code>$1</code></pre>'); // Code blocks
  formattedText = formattedText.replace(/`([^`]+)`/g, '<code>$1</code>'); // Inline code
  formattedText = formattedText.replace(/---/g, '<hr>'); // Horizontal rule
  formattedText = formattedText.replace(/\n/g, '<br>'); // New lines to <br> for HTML
-
-
- document.getElementById('output-text').innerHTML = formattedText; // Set formatted HTML output
- document.getElementById('generate-button').textContent = 'Generate';
- document.getElementById('generate-button').disabled = false;
- document.getElementById('loading-overlay').style.display = 'none'; // Hide loading overlay
+ return formattedText;
 }
 
 function generatePrompt(topic, learningOutcomes, ageGroup, outputType, timeMinutes, locationName) {
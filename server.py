@@ -0,0 +1,395 @@
+"""Local HTTP service for the STEAM Integration Generator.
+
+Serves the web page (index.html) and a small JSON API so one machine can generate for many teachers:
+
+    POST /api/generate   {"topic", "outcomes", "age_group", "output_type", "time_minutes", "location_name",
+                          "language", "stream", "bypass_cache", "parallel_sections"} -> {"output", "tokens", "truncated"} or a chunked text stream
+    POST /api/regenerate {the generate fields, "output", "section"} -> {"output", "section", "tokens", "truncated"}
+    POST /api/translate  {"text", "language"} -> {"output"}
+    POST /api/export     {"text"} -> DOCX file
+    GET  /api/health     -> {"status", "pending", "scheduler"}
+    GET  /metrics        -> Prometheus-style metrics
+
+Run with `python server.py --api-key YOUR_KEY` (or `--backend fake` / `--stub` to use a local model).
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import STEAM
+
+STATIC_FILES = {
+    "/": ("index.html", "text/html; charset=utf-8"),
+    "/index.html": ("index.html", "text/html; charset=utf-8"),
+    "/script.js": ("script.js", "application/javascript; charset=utf-8"),
+    "/style.css": ("style.css", "text/css; charset=utf-8"),
+}
+STATUS_TEXT = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error", 502: "Bad Gateway",
+               503: "Service Unavailable"}
+MAX_BODY_BYTES = 1024 * 1024
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class HttpError(Exception):
+    """Turns into an error response with a JSON body."""
+    def __init__(self, status, message, headers = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class SteamServer:
+    """asyncio HTTP server running generations in a thread pool, with per-client and overall limits.
+
+    A client (its address, or its X-Client-Id header if trust_client_id is set, which only makes sense behind a
+    proxy that sets or checks it) may have per_client requests running at once and gets 429 beyond that. Once max_pending requests are running or queued for the pool, new ones get 503, so a
+    burst is turned away quickly instead of piling up. Streamed responses wait for the client to keep up.
+    Pages from other origins may only call the API if allow_origin names their origin (or is "*").
+    """
+    def __init__(self, model = None, cache = None, workers = 8, per_client = 2, max_pending = 64, request_timeout = 180,
+                 allow_origin = None, trust_client_id = False):
+        self.model = model
+        self.allow_origin = allow_origin
+        self.trust_client_id = trust_client_id
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.per_client = per_client
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.pending = 0
+        self.active = {}
+
+    async def start(self, host = "127.0.0.1", port = 8000):
+        """Starts listening and returns the asyncio server."""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    # Connections
+    async def handle_connection(self, reader, writer):
+        """Serves requests on one connection until the client closes it or asks to."""
+        peer = writer.get_extra_info("peername")
+        address = peer[0] if peer else "unknown"
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HttpError as e:
+                    await self.send_json(writer, e.status, {"error": e.message}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                # The header is up to the client, so by default a client can't dodge its limit by changing it
+                client = (self.trust_client_id and headers.get("x-client-id")) or address
+                try:
+                    await self.route(writer, method, path, headers, body, client, keep_alive)
+                except HttpError as e:
+                    await self.send_json(writer, e.status, {"error": e.message}, e.headers, keep_alive)
+                except Exception as e:
+                    await self.send_json(writer, 500, {"error": f"Internal error: {e}"}, keep_alive=False)
+                    break
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Reads one HTTP/1.1 request, returning (method, path, headers, body) or None at end of stream."""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "Request headers too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HttpError(400, "Content-Length must be a number")
+        if length < 0:
+            raise HttpError(400, "Content-Length must not be negative")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target.split("?", 1)[0], headers, body
+
+    async def send(self, writer, status, body, content_type, headers = None, keep_alive = True):
+        """Writes a complete response."""
+        head = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}", "Connection: " + ("keep-alive" if keep_alive else "close")]
+        head.extend(self.cors_headers())
+        head.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    def origin_allowed(self, headers):
+        """Whether a request comes from this server's own page, a non-browser client or the allowed origin.
+
+        Browsers send some cross-origin POSTs without asking first, so the Origin header is checked as well.
+        """
+        origin = headers.get("origin")
+        if not origin or self.allow_origin in ("*", origin):
+            return True
+        return origin.split("://", 1)[-1] == headers.get("host")
+
+    def cors_headers(self):
+        """Returns the header lines letting the allowed origin read responses, none if only this origin may."""
+        return [f"Access-Control-Allow-Origin: {self.allow_origin}", "Vary: Origin"] if self.allow_origin else []
+
+    async def send_json(self, writer, status, data, headers = None, keep_alive = True):
+        await self.send(writer, status, json.dumps(data, ensure_ascii=False).encode("utf-8"),
+                        "application/json; charset=utf-8", headers, keep_alive)
+
+    # Routing
+    async def route(self, writer, method, path, headers, body, client, keep_alive):
+        if method == "OPTIONS":
+            await self.send(writer, 204, b"", "text/plain", {
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers": "Content-Type, X-Client-Id",
+            } if self.allow_origin else None, keep_alive)
+            return
+        if method == "GET" and path in STATIC_FILES:
+            file_name, content_type = STATIC_FILES[path]
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name), "rb") as static_file:
+                await self.send(writer, 200, static_file.read(), content_type, keep_alive=keep_alive)
+            return
+        if method == "GET" and path == "/metrics":
+            await self.send(writer, 200, STEAM.instrumentation.prometheus_text().encode("utf-8"),
+                            "text/plain; version=0.0.4", keep_alive=keep_alive)
+            return
+        if method == "GET" and path == "/api/health":
+            await self.send_json(writer, 200, {"status": "ok", "pending": self.pending,
+                                               "scheduler": STEAM.get_scheduler().metrics()}, keep_alive=keep_alive)
+            return
+        handlers = {"/api/generate": self.generate, "/api/regenerate": self.regenerate, "/api/translate": self.translate,
+                    "/api/export": self.export}
+        if path not in handlers:
+            raise HttpError(404, "Not found")
+        if method != "POST":
+            raise HttpError(405, "Use POST")
+        if not self.origin_allowed(headers):
+            raise HttpError(403, "Requests from other web pages are not allowed, see --allow-origin")
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(400, "Body must be JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "Body must be a JSON object")
+        self.admit(client)
+        try:
+            await handlers[path](writer, data, keep_alive)
+        finally:
+            self.release(client)
+
+    def admit(self, client):
+        """Reserves a slot for a request, or turns it away if the client or the server is at its limit."""
+        if self.active.get(client, 0) >= self.per_client:
+            raise HttpError(429, "Too many requests from this client at once", {"Retry-After": "1"})
+        if self.pending >= self.max_pending:
+            raise HttpError(503, "Server is busy, please try again shortly", {"Retry-After": "2"})
+        self.active[client] = self.active.get(client, 0) + 1
+        self.pending += 1
+
+    def release(self, client):
+        self.pending -= 1
+        self.active[client] -= 1
+        if not self.active[client]:
+            del self.active[client]
+
+    async def run_blocking(self, function, *args):
+        """Runs a blocking function in the generation pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # API
+    async def generate(self, writer, data, keep_alive):
+        try:
+            request = STEAM.parse_request(data)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        cache = None if data.get("bypass_cache") else self.cache
+        deadline = time.monotonic() + self.request_timeout
+        arguments = (request["topic"], request["outcomes"], request["age_group"], request["output_type"],
+                     request["time_minutes"], request["location_name"], request["language"])
+        parallel_sections = bool(data.get("parallel_sections"))
+        if data.get("stream"):
+            await self.stream_generation(writer, arguments, cache, deadline, parallel_sections, keep_alive)
+            return
+        details = {}
+        text = await self.run_blocking(
+            lambda: STEAM.generate_output(*arguments, model = self.model, cache = cache, deadline = deadline,
+                                          parallel_sections = parallel_sections, details = details)
+        )
+        if text.startswith("Error"):
+            raise HttpError(502, text)
+        await self.send_json(writer, 200, {"output": text, "tokens": STEAM.token_counts(details),
+                                           "truncated": bool(details.get("truncated"))}, keep_alive=keep_alive)
+
+    async def stream_generation(self, writer, arguments, cache, deadline, parallel_sections = False, keep_alive = True):
+        """Sends the output with chunked transfer encoding as the model produces it."""
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        cancel_event = threading.Event()
+        language = arguments[-1]
+
+        def produce():
+            try:
+                if language in STEAM.TRANSLATED_LANGUAGES:
+                    # Translation needs the whole text, so it arrives as one chunk
+                    text = STEAM.generate_output(*arguments, model = self.model, cache = cache, deadline = deadline,
+                                                 cancel_event = cancel_event, parallel_sections = parallel_sections)
+                    loop.call_soon_threadsafe(chunks.put_nowait, ("error" if text.startswith("Error") else "chunk", text))
+                else:
+                    for chunk in STEAM.stream_output(*arguments, model = self.model, cache = cache, deadline = deadline,
+                                                     cancel_event = cancel_event, parallel_sections = parallel_sections):
+                        loop.call_soon_threadsafe(chunks.put_nowait, ("chunk", chunk))
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, ("error", f"Error generating STEAM ideas: {e}"))
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, ("done", None))
+
+        producer = loop.run_in_executor(self.executor, produce)
+        head = ["HTTP/1.1 200 OK", "Content-Type: text/plain; charset=utf-8", "Transfer-Encoding: chunked",
+                "Cache-Control: no-cache", "Connection: " + ("keep-alive" if keep_alive else "close")]
+        head.extend(self.cors_headers())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        try:
+            while True:
+                kind, value = await chunks.get()
+                if kind == "done":
+                    break
+                if kind == "error":
+                    value = "\n\n" + value # Headers are already sent, so errors go at the end of the text
+                data = value.encode("utf-8")
+                if data:
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain() # Wait for slow clients instead of buffering without limit
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except ConnectionError:
+            cancel_event.set() # The client left, stop generating for it
+            raise
+        finally:
+            await producer
+
+    async def regenerate(self, writer, data, keep_alive):
+        """Rewrites one section of an output, returning the patched output and the new section."""
+        try:
+            request = STEAM.parse_request(data)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        if not isinstance(data.get("output") or "", str) or not isinstance(data.get("section") or "", str):
+            raise HttpError(400, "output and section must be strings")
+        document = STEAM.LessonDocument(data.get("output") or "")
+        index = document.find(data.get("section") or "")
+        if index is None:
+            raise HttpError(400, f"section must be one of: {', '.join(document.titles())}")
+        details = {}
+        deadline = time.monotonic() + self.request_timeout
+        try:
+            text = await self.run_blocking(
+                lambda: STEAM.regenerate_section(request, document, index, model = self.model, cache = self.cache,
+                                                 details = details, deadline = deadline)
+            )
+        except Exception as e:
+            raise HttpError(502, f"Error regenerating {document.sections[index]['title']}: {e}")
+        document.replace(index, text)
+        await self.send_json(writer, 200, {"output": document.text(), "section": text, "tokens": STEAM.token_counts(details),
+                                           "truncated": bool(details.get("truncated"))}, keep_alive=keep_alive)
+
+    async def translate(self, writer, data, keep_alive):
+        language = data.get("language") or "Nepali"
+        if not isinstance(language, str) or language not in STEAM.TRANSLATED_LANGUAGES:
+            raise HttpError(400, f"language must be one of: {', '.join(STEAM.TRANSLATED_LANGUAGES)}")
+        if not data.get("text") or not isinstance(data["text"], str):
+            raise HttpError(400, "text is required and must be a string")
+        text = await self.run_blocking(
+            lambda: STEAM.translate_document(data["text"], STEAM.TRANSLATED_LANGUAGES[language], cache = self.cache)
+        )
+        if text.startswith("Error"):
+            raise HttpError(502, text)
+        await self.send_json(writer, 200, {"output": text}, keep_alive=keep_alive)
+
+    async def export(self, writer, data, keep_alive):
+        if not data.get("text") or not isinstance(data["text"], str):
+            raise HttpError(400, "text is required and must be a string")
+
+        def build():
+            buffer = io.BytesIO()
+            STEAM.write_docx(data["text"], buffer)
+            return buffer.getvalue()
+
+        document = await self.run_blocking(build)
+        await self.send(writer, 200, document, DOCX_TYPE,
+                        {"Content-Disposition": 'attachment; filename="steam_ideas.docx"'}, keep_alive)
+
+
+async def serve(steam_server, host, port):
+    """Runs the server until interrupted."""
+    server = await steam_server.start(host, port)
+    print(f"Serving on http://{host}:{port}/", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="STEAM Integration Generator HTTP service")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (use 0.0.0.0 to serve the network)")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="Gemini API key (default: $GEMINI_API_KEY)")
+    parser.add_argument("--backend", default=os.environ.get("STEAM_BACKEND", "gemini"),
+                        help="Model backend: gemini, stub or fake, with options like fake:latency=0.5 (default: $STEAM_BACKEND or gemini)")
+    parser.add_argument("--stub", action="store_true", help="Use a local stub model instead of Gemini (same as --backend stub)")
+    parser.add_argument("--workers", type=int, default=8, help="Generations running at the same time")
+    parser.add_argument("--per-client", type=int, default=2, help="Requests one client may have running at once")
+    parser.add_argument("--max-pending", type=int, default=64, help="Requests accepted before new ones get 503")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    parser.add_argument("--allow-origin", metavar="ORIGIN",
+                        help="Let web pages from this origin (e.g. https://example.org, or * for any) call the API; "
+                             "by default only pages served by this server can")
+    parser.add_argument("--trust-client-id", action="store_true",
+                        help="Apply --per-client to each X-Client-Id header instead of each address "
+                             "(e.g. behind a proxy that sets the header)")
+    parser.add_argument("--cache-path", default=STEAM.CACHE_PATH, help="SQLite file used for the response cache")
+    args = parser.parse_args(argv)
+
+    try:
+        model = STEAM.make_backend("stub" if args.stub else args.backend)
+    except ValueError as e:
+        parser.error(str(e))
+    STEAM.use_backend(model)
+    if model is None:
+        if STEAM.validate_api_key(args.api_key):
+            STEAM.api_key = args.api_key
+        else:
+            parser.error("a valid Gemini API key is required, pass --api-key or set GEMINI_API_KEY")
+    STEAM.instrumentation.configure()
+    cache = None if args.no_cache else STEAM.ResponseCache(args.cache_path)
+    steam_server = SteamServer(model, cache, args.workers, args.per_client, args.max_pending,
+                               allow_origin = args.allow_origin, trust_client_id = args.trust_client_id)
+    try:
+        asyncio.run(serve(steam_server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
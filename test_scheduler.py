@@ -0,0 +1,151 @@
+"""Behaviour of the request scheduler against the benchmark's stand-in Gemini server and the fake backend."""
+import threading
+import time
+
+import pytest
+
+import STEAM
+from benchmark import StandInModel, start_stand_in
+
+
+@pytest.fixture
+def stand_in():
+    """A stand-in server answering every request with 429."""
+    server = start_stand_in(failure_rate = 1.0)
+    yield server
+    server.shutdown()
+
+
+class Flaky:
+    """Fails the first failures calls with error, then answers."""
+    def __init__(self, failures, error = None):
+        self.failures = failures
+        self.error = error or STEAM.BackendError(429, "Resource has been exhausted (e.g. check quota).")
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "ok"
+
+
+def quick_scheduler(**options):
+    options = {"requests_per_minute": 0, "max_retries": 3, "base_delay": 0.01, "max_delay": 0.05, **options}
+    return STEAM.RequestScheduler(**options)
+
+
+def record_sleeps(scheduler):
+    """Makes the scheduler's waits instant, returning the list of waits it asked for."""
+    sleeps = []
+    scheduler._sleep = lambda seconds, deadline, cancel_event: sleeps.append(seconds)
+    return sleeps
+
+
+def test_transient_errors_are_retried_until_max_retries(stand_in):
+    model = StandInModel(stand_in)
+    attempts = []
+    scheduler = quick_scheduler()
+
+    def call():
+        attempts.append(time.monotonic())
+        return model.generate_content("prompt")
+
+    with pytest.raises(Exception, match="429"):
+        scheduler.call(call)
+    metrics = scheduler.metrics()
+    assert len(attempts) == scheduler.max_retries + 1
+    assert metrics["retries"] == scheduler.max_retries
+    assert metrics["failed"] == 1 and metrics["completed"] == 0
+
+
+def test_retry_succeeds_after_transient_errors():
+    scheduler = quick_scheduler()
+    flaky = Flaky(2)
+    assert scheduler.call(flaky) == "ok"
+    assert flaky.calls == 3
+    assert scheduler.metrics()["retries"] == 2
+    assert scheduler.metrics()["completed"] == 1
+
+
+@pytest.mark.parametrize("error", [STEAM.BackendError(400, "Invalid argument"), ValueError("API key not valid")])
+def test_other_errors_are_not_retried(error):
+    scheduler = quick_scheduler()
+    flaky = Flaky(1, error)
+    with pytest.raises(type(error)):
+        scheduler.call(flaky)
+    assert flaky.calls == 1
+    assert scheduler.metrics()["retries"] == 0
+    assert scheduler.metrics()["failed"] == 1
+
+
+def test_backoff_doubles_with_jitter_within_bounds():
+    for _ in range(20):
+        scheduler = quick_scheduler(max_retries = 5, base_delay = 1.0, max_delay = 6.0)
+        sleeps = record_sleeps(scheduler)
+        scheduler.call(Flaky(5))
+        assert len(sleeps) == 5
+        for attempt, seconds in enumerate(sleeps):
+            delay = min(6.0, 2 ** attempt)
+            assert delay / 2 <= seconds <= delay
+
+
+def test_deadline_during_backoff_raises_request_timeout(stand_in):
+    model = StandInModel(stand_in)
+    scheduler = quick_scheduler(base_delay = 1.0, max_delay = 1.0)
+    started = time.monotonic()
+    with pytest.raises(STEAM.RequestTimeout, match="429"):
+        scheduler.call(lambda: model.generate_content("prompt"), deadline = started + 0.2)
+    assert time.monotonic() - started < 0.5 # Gave up at once instead of sleeping past the deadline
+    assert scheduler.metrics()["timed_out"] == 1
+
+
+def test_deadline_while_throttled_raises_request_timeout():
+    scheduler = quick_scheduler(requests_per_minute = 60, burst = 1)
+    scheduler.call(lambda: "first")
+    calls = []
+    with pytest.raises(STEAM.RequestTimeout):
+        scheduler.call(lambda: calls.append(1), deadline = time.monotonic() + 0.1)
+    assert calls == []
+    assert scheduler.request_bucket.level > -0.5 # The unused reservation was given back
+
+
+def test_cancel_while_throttled_refunds_the_budget():
+    scheduler = quick_scheduler(requests_per_minute = 60, tokens_per_minute = 6000, burst = 1)
+    scheduler.call(lambda: "first", tokens = 6000)
+    assert scheduler.request_bucket.level < 0.1 and scheduler.token_bucket.level < 100
+    cancel_event = threading.Event()
+    threading.Timer(0.05, cancel_event.set).start()
+    calls = []
+    started = time.monotonic()
+    with pytest.raises(STEAM.RequestCancelled):
+        scheduler.call(lambda: calls.append(1), tokens = 3000, cancel_event = cancel_event)
+    assert time.monotonic() - started < 0.5
+    assert calls == []
+    # Without the refund the buckets would be a whole request and 3000 tokens in debt
+    assert scheduler.request_bucket.level > -0.5
+    assert scheduler.token_bucket.level > -1000
+    metrics = scheduler.metrics()
+    assert metrics["cancelled"] == 1 and metrics["waiting"] == 0
+
+
+def test_cancel_during_backoff_stops_retrying():
+    scheduler = quick_scheduler(base_delay = 5.0, max_delay = 5.0)
+    cancel_event = threading.Event()
+    threading.Timer(0.05, cancel_event.set).start()
+    flaky = Flaky(10)
+    with pytest.raises(STEAM.RequestCancelled):
+        scheduler.call(flaky, cancel_event = cancel_event)
+    assert flaky.calls == 1
+
+
+def test_generation_survives_fake_backend_failures(monkeypatch):
+    scheduler = quick_scheduler(max_retries = 8)
+    monkeypatch.setattr(STEAM, "request_scheduler", scheduler)
+    model = STEAM.FakeBackend(latency = 0, words = 100, failure_rate = 0.5, seed = 3)
+    texts = [STEAM.generate_output(f"Topic {index}", ["observe"], "10", "Ideas", 30, model = model) for index in range(10)]
+    assert not any(text.startswith("Error") for text in texts)
+    metrics = scheduler.metrics()
+    assert metrics["completed"] == 10
+    assert model.calls == 10 + metrics["retries"]
+    assert metrics["retries"] > 0
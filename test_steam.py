@@ -0,0 +1,450 @@
+"""Tests for STEAM.py that run without an API key, using the local stub model."""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+import STEAM
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(monkeypatch):
+    """Gives every test its own scheduler without a request rate limit."""
+    monkeypatch.setattr(STEAM, "request_scheduler", STEAM.RequestScheduler(requests_per_minute = 0))
+
+
+def lesson_row(topic):
+    return {"topic": topic, "outcomes": ["observe", "measure"], "age": "10", "time": 45}
+
+
+def read_results(path):
+    with open(path, encoding="utf-8") as results_file:
+        return sorted((json.loads(line) for line in results_file), key=lambda result: result["index"])
+
+
+# Batch runs
+def test_run_batch_writes_every_row(tmp_path):
+    input_path = tmp_path / "rows.jsonl"
+    input_path.write_text("\n".join(json.dumps(lesson_row(f"Topic {i}")) for i in range(5)), encoding="utf-8")
+    output_path = tmp_path / "results.jsonl"
+    counts = STEAM.run_batch(str(input_path), str(output_path), workers = 2, max_pending = 2,
+                             model = STEAM.StubModel(delay = 0))
+    assert counts == {"done": 5, "failed": 0}
+    results = read_results(output_path)
+    assert [result["index"] for result in results] == list(range(5))
+    assert all(result["output"] and result["error"] is None for result in results)
+
+
+def test_run_batch_records_bad_rows_and_keeps_going(tmp_path):
+    input_path = tmp_path / "rows.jsonl"
+    lines = [json.dumps(lesson_row("Light")), json.dumps(lesson_row("Sound")), "{not json", "[1, 2]",
+             json.dumps({"topic": "Water"}), json.dumps(lesson_row("Plants"))]
+    input_path.write_text("\n".join(lines), encoding="utf-8")
+    output_path = tmp_path / "results.jsonl"
+    counts = STEAM.run_batch(str(input_path), str(output_path), model = STEAM.StubModel(delay = 0))
+    assert counts == {"done": 6, "failed": 3}
+    results = read_results(output_path)
+    assert [bool(result["error"]) for result in results] == [False, False, True, True, True, False]
+    assert set(results[2]) == {"index", "error"}
+    assert results[2]["error"].startswith("Error in row 2")
+
+
+def test_run_batch_stops_at_undecodable_csv_row(tmp_path):
+    input_path = tmp_path / "rows.csv"
+    input_path.write_bytes(b"topic,outcomes,age,time\nLight,observe,10,45\nSound,listen,10,45\n" + b"\xff" * 9000)
+    output_path = tmp_path / "results.jsonl"
+    counts = STEAM.run_batch(str(input_path), str(output_path), model = STEAM.StubModel(delay = 0))
+    results = read_results(output_path)
+    assert counts == {"done": 3, "failed": 1}
+    assert [result["error"] is None for result in results] == [True, True, False]
+    assert "not UTF-8" in results[-1]["error"]
+
+
+@pytest.mark.parametrize("name", ["rows.csv", "rows.jsonl"])
+def test_run_batch_reads_files_with_a_byte_order_mark(tmp_path, name):
+    input_path = tmp_path / name
+    if name.endswith(".csv"):
+        input_path.write_bytes(b"\xef\xbb\xbftopic,outcomes,age,time\nLight,observe,10,45\n")
+    else:
+        input_path.write_bytes(b"\xef\xbb\xbf" + json.dumps(lesson_row("Light")).encode("utf-8") + b"\n")
+    output_path = tmp_path / "results.jsonl"
+    counts = STEAM.run_batch(str(input_path), str(output_path), model = STEAM.StubModel(delay = 0))
+    assert counts == {"done": 1, "failed": 0}
+    assert read_results(output_path)[0]["topic"] == "Light"
+
+
+def test_run_batch_writes_started_rows_before_raising(tmp_path, monkeypatch):
+    def rows(path):
+        yield lesson_row("Light")
+        yield lesson_row("Sound")
+        raise OSError("disk went away")
+    monkeypatch.setattr(STEAM, "read_batch_rows", rows)
+    output_path = tmp_path / "results.jsonl"
+    with pytest.raises(OSError):
+        STEAM.run_batch("rows.jsonl", str(output_path), model = STEAM.StubModel(delay = 0.05))
+    assert [result["topic"] for result in read_results(output_path)] == ["Light", "Sound"]
+
+
+# Markdown-safe translation
+class FakeTranslator:
+    """Stands in for googletrans: upper-cases what it is sent and records it, optionally losing the placeholders."""
+    def __init__(self, drop_placeholders = False):
+        self.drop_placeholders = drop_placeholders
+        self.sent = []
+
+    def translate(self, text, dest):
+        self.sent.append(text)
+        if self.drop_placeholders:
+            text = STEAM.PLACEHOLDER_PATTERN.sub("", text)
+        return type("Translated", (), {"text": text.upper()})()
+
+
+@pytest.fixture
+def translator(monkeypatch):
+    monkeypatch.setattr(STEAM, "translation_memo", OrderedDict()) # Earlier tests' translations don't apply
+    return FakeTranslator()
+
+
+@pytest.mark.parametrize("text, translated", [
+    ("- Water cycle\n* Plants grow\n1. Measure it\n## Materials", "- WATER CYCLE\n* PLANTS GROW\n1. MEASURE IT\n## MATERIALS"),
+    ("**Objective:** observe *how* plants **grow** here", "**OBJECTIVE:** OBSERVE *HOW* PLANTS **GROW** HERE"),
+    ("  - Sort **{x}** and {} into sets", "  - SORT **{X}** AND {} INTO SETS"),
+    ("Leave {0} and {} alone **here**", "LEAVE {0} AND {} ALONE **HERE**"),
+])
+def test_translate_segments_keeps_markup(translator, text, translated):
+    assert STEAM.translate_segments(text, "ne", translator = translator) == translated
+    assert not any("*" in sent for sent in translator.sent) # Markers never reach the translator
+
+
+def test_split_and_join_round_trip():
+    text = "# Plan\n\n- **Step 1:** mix *slowly*\n**Bold line**\n  * nested {} item\n---"
+    template, segments = STEAM.split_translatable(text)
+    assert "Step 1:{0} mix {1}slowly" in segments
+    assert STEAM.join_translated(template, segments) == text
+
+
+def test_translate_chunk_retries_lines_that_lost_their_placeholders(translator):
+    translator.drop_placeholders = True
+    segments = ["Plants {0}need{1} light", "Water"]
+    assert STEAM.translate_chunk(segments, "ne", translator) == ["PLANTS {0}NEED{1} LIGHT", "WATER"]
+    assert translator.sent[1:] == ["Plants", "need", "light"] # One request per piece between the placeholders
+
+
+def test_translate_segments_survives_a_translator_dropping_placeholders(translator):
+    translator.drop_placeholders = True
+    text = "- Plants **need** light and *water*"
+    assert STEAM.translate_segments(text, "ne", translator = translator) == "- PLANTS **NEED** LIGHT AND *WATER*"
+
+
+# Section-indexed documents
+BOLD_LINE_PLAN = """**Lesson Plan: Light and Shadows**
+
+**1. Learning Objectives:**
+*   Students will explain how shadows form.
+
+**2. Engage (5 minutes)**
+Ask *why* shadows change during the day.
+
+**3. Explore**
+*   **Activity:** Trace a shadow every hour.
+
+**Detailed Lesson Procedure**
+*   **Engage (5 minutes):** Ask the opening question.
+*   **Explore (15 minutes):** Shadow tracing.
+"""
+
+BULLET_PLAN = """## Lesson Plan: Floating and Sinking
+
+*   **Title of the Lesson:** Will It Float?
+*   **Learning Objectives** (restating the outcomes)
+    *   Predict which objects float.
+*   **Engage** (Students guess which objects will float.)
+*   **Explore:** Test the objects in a tub of water.
+    *   **Materials:** a tub, a stone, a cork.
+*   **Explain** Density decides it.
+*   **Materials Needed:** tub, water, objects
+"""
+
+
+@pytest.mark.parametrize("line, title", [
+    ("**Engage**", "Engage"),
+    ("## 3. Explore:", "Explore"),
+    ("**2. Engage (5 minutes)**", "Engage (5 minutes)"),
+    ("*   **Engage** (Design an activity that captures attention.)", "Engage"),
+    ("**Engage:** Ask the class a question.", "Engage"),
+    ("1. **Evaluate:** A short quiz.", "Evaluate"),
+    ("*   **Activity:** Trace a shadow.", None),
+    ("**Note:** Keep water away from sockets.", None),
+    ("Ask *why* leaves are green.", None),
+    ("*   Plain bullet", None),
+])
+def test_section_title(line, title):
+    assert STEAM.section_title(line) == title
+
+
+def test_section_title_skips_sections_already_seen():
+    assert STEAM.section_title("*   **Engage (5 minutes):** Ask a question.", {"engage"}) is None
+    assert STEAM.section_title("**Engage**", {"engage"}) == "Engage" # A line of its own is always a heading
+
+
+def test_lesson_document_bold_line_headings():
+    document = STEAM.LessonDocument(BOLD_LINE_PLAN)
+    assert document.titles() == ["Lesson Plan: Light and Shadows", "Learning Objectives", "Engage (5 minutes)",
+                                 "Explore", "Detailed Lesson Procedure"]
+    assert document.text() == BOLD_LINE_PLAN
+    procedure = document.sections[document.find("Detailed Lesson Procedure")]["text"]
+    assert "Shadow tracing." in procedure # Phases listed in the procedure stay in it
+
+
+def test_lesson_document_bullet_headings():
+    document = STEAM.LessonDocument(BULLET_PLAN)
+    assert document.titles() == ["Lesson Plan: Floating and Sinking", "Title of the Lesson", "Learning Objectives",
+                                 "Engage", "Explore", "Explain", "Materials Needed"]
+    assert "a cork" in document.sections[document.find("explore")]["text"]
+    assert document.text() == BULLET_PLAN
+
+
+def test_lesson_document_replace_keeps_other_sections():
+    document = STEAM.LessonDocument(BULLET_PLAN)
+    index = document.find("Engage")
+    document.replace(index, "*   **Engage:** Drop a lemon in water.")
+    assert document.sections[index]["title"] == "Engage"
+    assert document.text() == BULLET_PLAN.replace(
+        "*   **Engage** (Students guess which objects will float.)", "*   **Engage:** Drop a lemon in water.")
+    assert "Drop a lemon" not in document.context(index)
+    assert "- Explore: Test the objects" in document.context(index)
+
+
+# Output token limits
+def generate_plan(model, cache, details, stream = False, parallel_sections = False):
+    arguments = ("Magnets", ["attract", "repel"], "10", "Lesson Plan", 45, "Kathmandu", "English")
+    options = dict(model = model, cache = cache, details = details, parallel_sections = parallel_sections)
+    if stream:
+        return "".join(STEAM.stream_output(*arguments, **options))
+    return STEAM.generate_output(*arguments, **options)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("parallel_sections", [False, True])
+def test_output_cut_off_at_the_token_limit_is_flagged_and_not_cached(stream, parallel_sections):
+    cache = STEAM.ResponseCache(":memory:")
+    details = {}
+    text = generate_plan(STEAM.FakeBackend(latency = 0, words = 5000), cache, details, stream, parallel_sections)
+    assert text and not text.startswith("Error")
+    assert details["truncated"]
+    assert "cut off at the output token limit" in STEAM.format_stages(details)
+    assert cache.stats()["entries"] == 0
+
+
+def test_complete_output_is_cached():
+    cache = STEAM.ResponseCache(":memory:")
+    details = {}
+    generate_plan(STEAM.FakeBackend(latency = 0, words = 200), cache, details)
+    assert not details.get("truncated")
+    assert "cut off" not in STEAM.format_stages(details)
+    assert cache.stats()["entries"] == 1
+
+
+def test_response_truncated_reads_the_finish_reason():
+    assert STEAM.response_truncated(STEAM.StubResponse("text", finish_reason = "MAX_TOKENS"))
+    assert STEAM.response_truncated(STEAM.StubResponse("text", finish_reason = 2))
+    assert not STEAM.response_truncated(STEAM.StubResponse("text"))
+    assert not STEAM.response_truncated(object())
+
+
+# Model backends
+def test_model_backend_requires_generate_content():
+    class Incomplete(STEAM.ModelBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+    assert isinstance(STEAM.make_backend("fake:latency=0"), STEAM.ModelBackend)
+
+
+# Similar past lessons
+def make_lesson(topic, output_type = "Lesson Plan", location = "Kathmandu"):
+    return STEAM.make_request(topic, ["explain how plants make food"], "10-12", output_type, 45, location, "English")
+
+
+def test_similarity_index_finds_near_duplicates():
+    index = STEAM.SimilarityIndex()
+    index.add(1, make_lesson("Photosynthesis"))
+    index.add(2, make_lesson("Volcanoes"))
+    results = index.search(make_lesson("photosynthesis"))
+    assert [result["id"] for result in results] == [1]
+    assert results[0]["score"] == 1.0
+
+
+def test_similarity_index_compares_lesson_plan_locations():
+    index = STEAM.SimilarityIndex()
+    index.add(1, make_lesson("Photosynthesis", location = "Kathmandu"))
+    assert index.search(make_lesson("Photosynthesis", location = "Pokhara")) == []
+    assert [result["id"] for result in index.search(make_lesson("Photosynthesis", location = " kathmandu "))] == [1]
+
+
+def test_similarity_index_ignores_location_for_ideas():
+    index = STEAM.SimilarityIndex()
+    index.add(1, make_lesson("Photosynthesis", "Ideas", "Kathmandu"))
+    assert [result["id"] for result in index.search(make_lesson("Photosynthesis", "Ideas", "Pokhara"))] == [1]
+
+
+# Request coalescing
+def wait_until(condition, timeout = 2.0):
+    limit = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < limit, "timed out"
+        time.sleep(0.005)
+
+
+def run_in_thread(function):
+    """Starts function in a thread, returning a dict that gets its "result" or "error"."""
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = function()
+        except Exception as e:
+            outcome["error"] = e
+    thread = threading.Thread(target = run)
+    thread.start()
+    outcome["thread"] = thread
+    return outcome
+
+
+class Gate:
+    """produce function for SingleFlight that blocks until released, counting its calls."""
+    def __init__(self, result = "text", error = None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.release = threading.Event()
+        self.cancelled = None
+
+    def __call__(self, cancel_event, details):
+        self.calls += 1
+        self.cancelled = cancel_event
+        details["stages"] = {"model": 1.0}
+        while not self.release.wait(0.01):
+            if cancel_event.is_set():
+                raise STEAM.RequestCancelled("Request cancelled")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_single_flight_shares_one_call():
+    flights = STEAM.SingleFlight()
+    gate = Gate()
+    first = run_in_thread(lambda: flights.call("key", gate))
+    wait_until(lambda: gate.calls == 1)
+    details = {}
+    second = run_in_thread(lambda: flights.call("key", gate, details = details))
+    wait_until(lambda: flights._flights["key"].waiters == 2)
+    gate.release.set()
+    first["thread"].join()
+    second["thread"].join()
+    assert first["result"] == second["result"] == "text"
+    assert gate.calls == 1
+    assert details["coalesced"]
+
+
+def test_single_flight_gives_every_waiter_the_error():
+    flights = STEAM.SingleFlight()
+    gate = Gate(error = STEAM.BackendError(400, "Invalid argument"))
+    waiters = [run_in_thread(lambda: flights.call("key", gate)) for _ in range(3)]
+    wait_until(lambda: gate.calls == 1 and flights._flights["key"].waiters == 3)
+    gate.release.set()
+    for waiter in waiters:
+        waiter["thread"].join()
+        assert isinstance(waiter["error"], STEAM.BackendError)
+    assert gate.calls == 1 and flights.in_flight() == 0
+
+
+def test_single_flight_cancels_the_call_once_every_waiter_left():
+    flights = STEAM.SingleFlight()
+    gate = Gate()
+    first_cancel, second_cancel = threading.Event(), threading.Event()
+    first = run_in_thread(lambda: flights.call("key", gate, cancel_event = first_cancel))
+    wait_until(lambda: gate.calls == 1)
+    second = run_in_thread(lambda: flights.call("key", gate, cancel_event = second_cancel))
+    wait_until(lambda: flights._flights["key"].waiters == 2)
+    first_cancel.set()
+    first["thread"].join()
+    assert isinstance(first["error"], STEAM.RequestCancelled)
+    assert not gate.cancelled.is_set() # The second caller still waits
+    second_cancel.set()
+    second["thread"].join()
+    assert isinstance(second["error"], STEAM.RequestCancelled)
+    wait_until(gate.cancelled.is_set)
+    assert flights.in_flight() == 0
+
+
+def test_single_flight_follower_keeps_its_own_deadline():
+    flights = STEAM.SingleFlight()
+    gate = Gate()
+    leader = run_in_thread(lambda: flights.call("key", gate, deadline = time.monotonic() + 0.1))
+    wait_until(lambda: gate.calls == 1)
+    follower = run_in_thread(lambda: flights.call("key", gate)) # No deadline at all
+    wait_until(lambda: flights._flights["key"].waiters == 2)
+    leader["thread"].join()
+    assert isinstance(leader["error"], STEAM.RequestTimeout)
+    time.sleep(0.05)
+    assert not gate.cancelled.is_set()
+    gate.release.set()
+    follower["thread"].join()
+    assert follower["result"] == "text"
+
+
+def test_single_flight_adds_to_the_callers_stage_timings():
+    flights = STEAM.SingleFlight()
+    details = {"stages": {"render": 0.25, "model": 0.5}}
+
+    def produce(cancel_event, flight_details):
+        flight_details["stages"] = {"prompt": 0.1, "model": 1.0}
+        yield "chunk"
+    assert list(flights.stream("key", produce, details = details)) == ["chunk"]
+    assert details["stages"] == {"render": 0.25, "model": 1.5, "prompt": 0.1}
+
+
+# History
+def test_history_keeps_truncated_outputs_marked():
+    store = STEAM.HistoryStore(":memory:")
+    complete = store.add(make_lesson("Magnets"), "**Engage**\nFull plan", {"output_tokens": 900})
+    cut_off = store.add(make_lesson("Volcanoes"), "**Engage**\nHalf a pl", {"output_tokens": 2350, "truncated": True})
+    assert store.get(cut_off)["truncated"] == 1 and store.get(cut_off)["output"].endswith("Half a pl")
+    assert store.get(complete)["truncated"] == 0
+    assert [row["truncated"] for row in store.page()] == [1, 0]
+    assert [entry_id for entry_id, _ in store.iter_requests()] == [complete] # Never offered for reuse
+
+
+def test_history_adds_the_truncated_column_to_older_files(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE history (id INTEGER PRIMARY KEY, created REAL NOT NULL, topic TEXT NOT NULL, outcomes TEXT, "
+        "age_group TEXT, output_type TEXT, time_minutes INTEGER, location_name TEXT, language TEXT, model TEXT, "
+        "output TEXT NOT NULL, elapsed REAL, prompt_tokens INTEGER, output_tokens INTEGER)"
+    )
+    connection.execute("INSERT INTO history (created, topic, output) VALUES (0, 'Old', 'old output')")
+    connection.commit()
+    connection.close()
+    store = STEAM.HistoryStore(path)
+    assert store.get(1)["truncated"] == 0
+    store.add(make_lesson("New"), "new output", {"truncated": True})
+    assert [row["truncated"] for row in store.page()] == [1, 0]
+    store.close()
+
+
+# Startup
+def test_startup_within_budget():
+    from benchmark import bench_startup
+    results = bench_startup(runs = 1)
+    assert "error" not in results, results.get("error")
+    assert results["eager_modules"] == [] # Gemini, googletrans and python-docx load on first use
+    if "key_window_ms" not in results:
+        pytest.skip("no display to draw the API key window on")
+    assert not results["over_budget"], f"API key window took {results['key_window_ms']} ms (budget {results['budget_ms']} ms)"